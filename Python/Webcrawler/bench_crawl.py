@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""
+  Reproducible benchmark for crawler.py and selite.py. A synthetic web site
+  is served on the loopback interface, both crawlers are run against it as
+  separate processes, and for each run the pages and bytes per second, the
+  CPU time and the peak memory (RSS) are recorded.
+
+  The site is generated from a seed, so every run sees the same pages. Its
+  size, fan-out, page size, response latency, error rate and the fraction
+  of links to non-HTML files can be set on the command line. selite.py
+  can't handle non-HTML files, so it gets the same site without them.
+  Text responses are gzip-compressed for clients that ask for it, unless
+  --no-gzip is given; the bytes counted are the bytes sent.
+
+  crawler.py stores the pages it fetches in a WARC file, and selite.py is
+  run once more on that file ("selite-warc"), which times its indexing
+  without the network. Its bytes are the size of the WARC file.
+
+  With --spellings, every link to a page is written in one of several
+  spellings of the same URL (parameters in another order, tracking
+  parameters, dot segments, & written as &amp; like in HTML), and the
+  benchmark fails if crawler.py fetches a page more than once.
+
+  crawler.py takes only a few URLs more from its queue than it can fetch
+  right away. The site has a single host, so with --delay (in
+  --crawler-args) that host waits between fetches and no other host can
+  be; the benchmark fails if more URLs than crawler.py allows for one
+  host waited in memory at once.
+
+  The results are compared with a stored baseline (bench_baseline.json
+  next to this script, or --baseline), which --save writes.
+
+  Example:
+      python bench_crawl.py --pages 500 --latency 0.01 --save
+      python bench_crawl.py --pages 500 --latency 0.01
+      python bench_crawl.py --pages 2000 --crawler-args "--order opic --delay 0.01"
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FILE_TYPES = [("pdf", "application/pdf"), ("png", "image/png"), ("zip", "application/zip")]
+
+# Spellings of the link to a page, all the same URL in canonical form
+SPELLINGS = ("/p/%d.html?a=1&amp;b=2", "/p/%d.html?b=2&amp;a=1", "/p/./%d.html?a=1&amp;b=2&amp;utm_source=bench",
+             "/x/../p/%d.html?utm_medium=web&amp;b=2&amp;a=1", "/p/%d.html?sid=7&b=2&a=1")
+
+WORDS = ("crawler page link search index rank query term document web site host "
+         "python queue fetch parse network server client cache").split()
+
+
+class SyntheticSite(object):
+
+    """A web site of pages numbered 0 to pages - 1, generated from a seed.
+    Page i links to page i + 1 (so every page can be reached from page 0)
+    and to fanout - 1 other pages; a fraction mime_mix of these links go
+    to non-HTML files instead. A fraction error_rate of all URLs answers
+    with a server error. With spellings, links to pages are written in
+    one of SPELLINGS."""
+
+    def __init__(self, pages=300, fanout=10, page_size=20000, latency=0.0, error_rate=0.0, mime_mix=0.0, seed=1,
+                 spellings=False):
+        self.pages = pages
+        self.fanout = fanout
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.mime_mix = mime_mix
+        self.seed = seed
+        self.spellings = spellings
+
+    def _random(self, path):
+        return random.Random("%d:%s" % (self.seed, path))
+
+    def is_error(self, path):
+        return path != "/p/0.html" and self._random("error" + path).random() < self.error_rate
+
+    def href(self, i, rnd):
+        return rnd.choice(SPELLINGS) % i if self.spellings else "/p/%d.html" % i
+
+    def page(self, i):
+        rnd = self._random("page%d" % i)
+        spelling = self._random("spelling%d" % i)
+        links = ['<a href="%s">next</a>' % self.href((i + 1) % self.pages, spelling)]
+        for _ in range(self.fanout - 1):
+            if rnd.random() < self.mime_mix:
+                ext, mime_type = rnd.choice(FILE_TYPES)
+                links.append('<a href="/f/%d.%s">file</a>' % (rnd.randrange(self.pages), ext))
+            else:
+                links.append('<a href="%s">page</a>' % self.href(rnd.randrange(self.pages), spelling))
+        head = "<html><head><title>Page %d</title></head><body><h1>Page %d</h1>" % (i, i)
+        tail = "<ul><li>%s</li></ul></body></html>" % "</li><li>".join(links)
+        words = []
+        size = len(head) + len(tail)
+        while size < self.page_size:
+            word = rnd.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return (head + "<p>" + " ".join(words) + "</p>" + tail).encode("utf-8")
+
+    def response(self, path):
+        """response(path) -> status, content type, body"""
+        if path == "/":
+            path = "/p/0.html"
+        if self.is_error(path):
+            return 500, "text/plain", b"Internal Server Error"
+        try:
+            if path.startswith("/p/") and path.endswith(".html"):
+                i = int(path[3:-5])
+                if 0 <= i < self.pages:
+                    return 200, "text/html; charset=utf-8", self.page(i)
+            if path.startswith("/f/"):
+                for ext, mime_type in FILE_TYPES:
+                    if path.endswith("." + ext):
+                        return 200, mime_type, self._random(path).randbytes(4096)
+        except ValueError:
+            pass
+        return 404, "text/plain", b"Not Found"
+
+
+class SiteServer(object):
+
+    """Serves a SyntheticSite on 127.0.0.1 from a background thread and
+    counts what it serves"""
+
+    def __init__(self, site, compress=True):
+        self.site = site
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.reset()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond(head=False)
+
+            def do_HEAD(self):
+                self.respond(head=True)
+
+            def respond(self, head):
+                if server.site.latency:
+                    time.sleep(server.site.latency)
+                path = self.path.split("?")[0]
+                status, content_type, body = server.site.response(path)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                if (server.compress and content_type.startswith("text/") and
+                        "gzip" in self.headers.get("Accept-Encoding", "")):
+                    body = gzip.compress(body, 6)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if head:
+                    body = b""
+                else:
+                    self.wfile.write(body)
+                server.count(status, content_type, len(body), head, path)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.pages = 0                          # HTML pages served with status 200
+            self.bytes = 0
+            self.fetched = Counter()                # Path -> times served as an HTML page
+
+    def count(self, status, content_type, size, head=False, path=None):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            if status == 200 and content_type.startswith("text/html") and not head:
+                self.pages += 1
+                self.fetched[path] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def run_process(command, server, pages=None, size=None):
+    """Run command to completion, returning its measurements as a dict.
+    pages and size replace the pages and bytes served, for a command that
+    does not use the server."""
+    server.reset()
+    with tempfile.TemporaryDirectory() as cwd:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = process.stderr.read()
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        log = os.path.join(cwd, "crawler.log")
+        waited = None
+        if os.path.exists(log):
+            with open(log) as f:
+                waited = re.findall(r"At most (\d+) URLs waited for their host", f.read())
+    if os.waitstatus_to_exitcode(status) != 0:
+        print(stderr.decode("utf-8", errors="replace"), file=sys.stderr)
+        raise SystemExit("%s failed" % " ".join(command))
+    pages = server.pages if pages is None else pages
+    size = server.bytes if size is None else size
+    rss_kb = usage.ru_maxrss if sys.platform != "darwin" else usage.ru_maxrss / 1024
+    result = {"wall_seconds": wall,
+              "cpu_seconds": usage.ru_utime + usage.ru_stime,
+              "peak_rss_mb": rss_kb / 1024.0,
+              "requests": server.requests,
+              "pages": pages,
+              "bytes": size,
+              "pages_per_second": pages / wall,
+              "bytes_per_second": size / wall}
+    if waited:
+        result["max_waiting"] = int(waited[-1])
+    return result
+
+
+def waiting_limit(crawler_args):
+    """Most URLs crawler.py lets wait in memory for a single host: 100
+    per worker with bfs, 2 per worker with the other orders, and twice
+    that while no host is ready"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--order", default="bfs")
+    opts, _ = parser.parse_known_args(crawler_args)
+    return 2 * (100 if opts.order == "bfs" else 2) * opts.workers
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every measurement against the baseline; returns
+    the number of regressions larger than tolerance (a fraction)"""
+    higher_is_better = {"pages_per_second", "bytes_per_second"}
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        print("\n%s vs. baseline" % name)
+        for metric in ("pages_per_second", "bytes_per_second", "cpu_seconds", "peak_rss_mb"):
+            old, new = baseline[name][metric], result[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if metric in higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("  %-18s %12.2f -> %12.2f  %+6.1f%%%s" % (metric, old, new, 100 * change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300, help="Number of pages on the site")
+    parser.add_argument("--fanout", type=int, default=10, help="Links per page")
+    parser.add_argument("--page-size", type=int, default=20000, help="Size of a page in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Fraction of URLs that give a server error")
+    parser.add_argument("--mime-mix", type=float, default=0.1, help="Fraction of links to non-HTML files")
+    parser.add_argument("--no-gzip", action="store_false", dest="gzip",
+                        help="Never send compressed responses")
+    parser.add_argument("--spellings", action="store_true",
+                        help="Spell links to the same page in different ways")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--depth", type=int, default=1000, help="Depth limit for crawler.py")
+    parser.add_argument("--crawler-args", default="-w 8",
+                        help="Extra arguments for crawler.py (default is '-w 8')")
+    parser.add_argument("--skip", choices=["crawler", "selite", "selite-warc"], action="append", default=[],
+                        help="Don't run this crawler")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "bench_baseline.json"))
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Change against the baseline that counts as a regression (default is 0.1)")
+    args = parser.parse_args()
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency, args.error_rate, args.mime_mix, args.seed,
+                         args.spellings)
+    warc_dir = tempfile.TemporaryDirectory()
+    warc_path = os.path.join(warc_dir.name, "crawl.warc.gz")
+    runs = []
+    if "crawler" not in args.skip:
+        runs.append(("crawler", site, lambda url: [sys.executable, os.path.join(HERE, "crawler.py"), "-d", str(args.depth),
+                                                   "--ignore-robots", "--warc", warc_path] + args.crawler_args.split() + [url]))
+    if "selite" not in args.skip:
+        html_only = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency, args.error_rate, 0.0, args.seed,
+                                  args.spellings)
+        runs.append(("selite", html_only, lambda url: [sys.executable, os.path.join(HERE, "selite.py"), "crawler", url]))
+
+    results = {}
+    with warc_dir:
+        for name, run_site, command in runs:
+            with SiteServer(run_site, args.gzip) as server:
+                results[name] = run_process(command(server.url), server)
+                if name == "crawler" and args.spellings:
+                    again = sum(n - 1 for n in server.fetched.values())
+                    if again:
+                        raise SystemExit("crawler.py fetched %d pages more than once" % again)
+                    print("crawler.py fetched each of %d pages once" % len(server.fetched))
+                if name == "crawler" and "max_waiting" in results[name]:
+                    waited, limit = results[name]["max_waiting"], waiting_limit(args.crawler_args.split())
+                    if waited > limit:
+                        raise SystemExit("%d URLs waited for their host in crawler.py, %d allowed" % (waited, limit))
+                    print("At most %d URLs waited for their host in crawler.py (%d allowed)" % (waited, limit))
+                if name == "crawler" and "selite-warc" not in args.skip:
+                    # The server stays up, to show that nothing is requested
+                    offline = [sys.executable, os.path.join(HERE, "selite.py"), "crawler", "--warc", warc_path]
+                    results["selite-warc"] = run_process(offline, server, results[name]["pages"],
+                                                         os.path.getsize(warc_path))
+                    if server.requests:
+                        raise SystemExit("selite.py made %d requests reading a WARC file" % server.requests)
+
+    print("%-12s %8s %10s %12s %10s %10s" % ("", "pages", "pages/s", "MB/s", "CPU (s)", "RSS (MB)"))
+    for name, r in results.items():
+        print("%-12s %8d %10.1f %12.2f %10.2f %10.1f" % (name, r["pages"], r["pages_per_second"],
+                                                       r["bytes_per_second"] / 1e6, r["cpu_seconds"], r["peak_rss_mb"]))
+
+    settings = {k: v for k, v in vars(args).items() if k not in ("baseline", "save", "tolerance", "skip")}
+    regressions = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print("\nNote: the baseline was recorded with different settings: %s" % baseline.get("settings"))
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+        print("\nBaseline saved to %s" % args.baseline)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+  Measures building the tf-idf index of selite.py, from pages that have
+  been crawled already to normalized weights, against the previous build,
+  which made a dict of lists of tuples for every step and computed the
+  length of each document separately. For both the time and the peak
+  memory (as seen by tracemalloc) are reported, and the weights are
+  checked to be the same.
+
+  The pages are generated: words are drawn with Zipf-like frequencies
+  from a vocabulary, so a few terms are in every page and most in few.
+
+  Example:
+      python bench_index.py 10000
+"""
+
+import sys
+import time
+import random
+import itertools
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+import selite
+
+
+def legacy_index(pages):
+    """create_index, weight_index and normalize_index as they were"""
+    N = len(pages)
+    index = defaultdict(list)
+    for url, content, links in pages:
+        for term, count in selite.count_terms(content).items():
+            index[term].append((url, count))
+    weighted_index = defaultdict(list)
+    for term, docs in index.items():
+        df = len(docs)
+        for url, count in docs:
+            weighted_index[term].append((url, (1 + np.log10(count)) * np.log10(N / df)))
+    doc_vectors = defaultdict(list)
+    for docs in weighted_index.values():
+        for url, weight in docs:
+            doc_vectors[url].append(weight)
+    lengths = {url: np.linalg.norm(doc) for url, doc in doc_vectors.items()}
+    norm_index = defaultdict(list)
+    for term, docs in weighted_index.items():
+        for url, weight in docs:
+            norm_index[term].append((url, weight / lengths[url]))
+    return norm_index
+
+
+def vectorized_index(pages):
+    """The index build of selite.py"""
+    index = selite.create_index(pages)
+    weights = selite.normalize_index(index, selite.weight_index(index, len(pages)))
+    return selite.invert_index(index, weights, pages, np.zeros(len(pages)))
+
+
+def synthetic_pages(n, words=300, vocabulary=50000, seed=1):
+    rnd = random.Random(seed)
+    terms = ["w%d" % i for i in range(vocabulary)]
+    cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(vocabulary)))
+    return [("http://example.com/%d" % i, " ".join(rnd.choices(terms, cum_weights=cum_weights, k=words)), [])
+            for i in range(n)]
+
+
+def measure(build, pages):
+    """measure(build, pages) -> index, seconds, peak MB
+
+    tracemalloc slows everything down, so the build is timed without it
+    and run once more to find the peak memory"""
+    start = time.perf_counter()
+    index = build(pages)
+    seconds = time.perf_counter() - start
+    del index
+    tracemalloc.start()
+    index = build(pages)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return index, seconds, peak / 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pages = synthetic_pages(n)
+    print("%d pages, %d words" % (n, sum(len(c.split()) for u, c, l in pages)))
+
+    legacy, legacy_seconds, legacy_peak = measure(legacy_index, pages)
+    index, seconds, peak = measure(vectorized_index, pages)
+    print("%-12s %10s %12s" % ("", "seconds", "peak MB"))
+    print("%-12s %10.2f %12.1f" % ("legacy", legacy_seconds, legacy_peak))
+    print("%-12s %10.2f %12.1f" % ("vectorized", seconds, peak))
+
+    assert sorted(legacy) == list(index.terms)
+    for term in index.terms:
+        expected = legacy[term]
+        postings = index[term]
+        assert [url for url, w in expected] == [url for url, w in postings], term
+        # The previous build gave NaN for documents of length 0, now 0
+        assert np.allclose(np.nan_to_num([w for url, w in expected]), [w for url, w in postings], rtol=1e-9), term
+    print("Same weights for all %d terms" % len(index))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+  Micro-benchmark for collecting the out-links of link-heavy pages such as
+  sitemaps and index pages. Compares Fetcher.add_out_links, which keeps
+  the links in a dict, with the previous list-based duplicate check.
+
+  Example:
+      python bench_outlinks.py 1000 10000 50000
+"""
+
+import sys
+import time
+import random
+import urllib.parse
+from html import escape
+
+from crawler import Fetcher
+
+
+def sitemap_hrefs(n, seed=1):
+    """Hrefs of a page with n links, about a tenth of them duplicates"""
+    rnd = random.Random(seed)
+    return ["/articles/%d/index.html" % rnd.randrange(int(n * 0.9) + 1) for _ in range(n)]
+
+
+def list_out_links(base, hrefs):
+    out_urls = []
+    for href in hrefs:
+        url = urllib.parse.urljoin(base, escape(href))
+        if url not in out_urls:
+            out_urls.append(url)
+    return out_urls
+
+
+def dict_out_links(base, hrefs):
+    page = Fetcher(base, 5)
+    page.add_out_links(base, hrefs)
+    return page.out_links()
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 5000, 20000]
+    base = "http://example.com/sitemap.html"
+
+    print("%8s %12s %12s %10s" % ("links", "list (s)", "dict (s)", "speed-up"))
+    for n in sizes:
+        hrefs = sitemap_hrefs(n)
+        expected, list_time = timed(list_out_links, base, hrefs)
+        found, dict_time = timed(dict_out_links, base, hrefs)
+        assert found == expected, "out-links differ"
+        print("%8d %12.4f %12.4f %9.1fx" % (n, list_time, dict_time, list_time / dict_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+  Measures answering queries with selite.py's combined_search, which
+  only looks for the best k results, against the previous search, which
+  scored every document that contains a query term and sorted them all
+  (twice). Both search the same index, in memory or opened from disk
+  with --disk, and must give the same results. Reported is the average
+  time of a query, and how many documents matched it on average.
+
+  The pages are those of bench_index.py, with skewed (PageRank-like)
+  ranks, so the queries with frequent terms match most documents.
+
+  Example:
+      python bench_search.py --pages 20000 --pages 100000 --disk
+"""
+
+import time
+import random
+import argparse
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+
+import selite
+from bench_index import synthetic_pages
+from diskindex import DiskIndex, write_index
+
+QUERIES = ["w0 w1", "w2 w10 w50", "w3", "w100 w1000", "w5 w20000", "w30000 w40000", "w7 w8 w9 w11"]
+
+
+def legacy_search(index, N, rank, query):
+    """cosine_similarity and combined_search as they were"""
+    scores = defaultdict(int)
+    qw = {t: selite.tf_idf(1, N, len(index[t])) for t in query.split() if t in index}
+    query_len = np.linalg.norm(list(qw.values()))
+    for term in qw:
+        query_weight = qw[term] / query_len
+        for url, weight in index[term]:
+            scores[url] += weight * query_weight
+    scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    combined = [(doc, score * rank[doc]) for doc, score in scores]
+    return sorted(combined, key=lambda x: x[1], reverse=True)
+
+
+def build(n, seed=1):
+    pages = synthetic_pages(n, words=100, seed=seed)
+    rnd = random.Random(seed)
+    ranks = np.array([rnd.paretovariate(1.2) for i in range(n)])
+    index = selite.create_index(pages)
+    weights = selite.normalize_index(index, selite.weight_index(index, n))
+    return selite.invert_index(index, weights, pages, ranks / ranks.sum())
+
+
+def timed(search, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        results = search()
+    return results, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, action="append", help="Pages in an index (default is 2000 and 20000)")
+    parser.add_argument("-k", type=int, default=selite.max_results)
+    parser.add_argument("--disk", action="store_true", help="Search the index written to disk")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for n in args.pages or [2000, 20000]:
+        index = build(n)
+        with tempfile.TemporaryDirectory() as path:
+            if args.disk:
+                write_index(path, index)
+                index = DiskIndex(path)
+            rank = index.rank
+            legacy_seconds = seconds = matched = 0
+            for query in QUERIES:
+                expected, t = timed(lambda: legacy_search(index, n, rank, query), args.repeat)
+                legacy_seconds += t
+                results, t = timed(lambda: selite.combined_search(index, query, args.k), args.repeat)
+                seconds += t
+                matched += len(expected)
+                expected = expected[:args.k]
+                assert [url for url, s in expected] == [url for url, s in results], query
+                assert np.allclose([s for url, s in expected], [s for url, s in results], rtol=1e-6), query
+            print("\n%d pages, %d matches per query, top %d%s" % (n, matched / len(QUERIES), args.k,
+                                                                ", on disk" if args.disk else ""))
+            print("%-12s %12s" % ("", "ms/query"))
+            print("%-12s %12.2f" % ("legacy", legacy_seconds / len(QUERIES) * 1000))
+            print("%-12s %12.2f" % ("top-k", seconds / len(QUERIES) * 1000))
+            del index
+    print("\nSame results for all queries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+  Guessing the content type of a URL before fetching it, for crawler.py.
+  The crawler only reads HTML pages, so a URL that will give an image, a
+  PDF or an archive is better not requested at all.
+
+  The guess is based on the extension of the last path segment, and on the
+  content types that were seen so far for similar URLs on the same host:
+  URLs with the same directory (with runs of digits taken as equal) and
+  extension. What was seen for a host wins over the extension, so a site
+  that serves its pages from /view.pdf is still crawled.
+"""
+
+import re
+
+from urlfilter import parse_url
+
+HTML = "html"
+OTHER = "other"
+
+# Extensions of files that are (almost) never HTML
+NON_HTML_EXTENSIONS = frozenset("""
+    jpg jpeg png gif bmp svg webp ico tif tiff avif heic
+    pdf ps eps doc docx xls xlsx ppt pptx odt ods odp rtf epub
+    zip gz tgz bz2 xz 7z rar tar jar exe msi dmg iso bin img apk deb rpm
+    mp3 mp4 m4a m4v avi mov wmv flv mkv webm ogg oga ogv wav flac aac
+    css js mjs json xml rss atom txt csv tsv woff woff2 ttf eot otf
+    """.split())
+
+# Extensions of pages that are usually HTML; no extension counts as one
+HTML_EXTENSIONS = frozenset("html htm xhtml shtml php php3 php4 php5 asp aspx jsp jspx cfm cgi pl py".split())
+
+_DIGITS = re.compile(r"\d+")
+
+
+def extension(path):
+    """The extension of the last segment of path in lower case, or "" """
+    name = path.rpartition("/")[2]
+    stem, dot, ext = name.rpartition(".")
+    if not dot or not stem or len(ext) > 5 or not ext.isalnum():
+        return ""
+    return ext.lower()
+
+
+def path_pattern(path):
+    """The directory of path with runs of digits replaced by #, followed
+    by the extension, for instance /img/2024/a.jpg -> /img/#/*.jpg"""
+    directory = path.rpartition("/")[0]
+    ext = extension(path)
+    return _DIGITS.sub("#", directory) + "/*" + ("." + ext if ext else "")
+
+
+class ContentTypePredictor(object):
+
+    """Predicts whether a URL gives HTML. Content types seen for a host are
+    trusted once at least min_seen URLs of the same path pattern gave the
+    same kind of content (and no URL another kind)."""
+
+    def __init__(self, min_seen=3, max_patterns=100000):
+        self.min_seen = min_seen
+        self.max_patterns = max_patterns
+        self._seen = {}                             # (host, pattern) -> [URLs that gave HTML, URLs that did not]
+
+    def predict(self, url):
+        """HTML, OTHER, or None if there's no telling"""
+        parts = parse_url(url)
+        learned = self._seen.get((parts.host, path_pattern(parts.path)))
+        if learned is not None:
+            html, other = learned
+            if other == 0 and html >= self.min_seen:
+                return HTML
+            if html == 0 and other >= self.min_seen:
+                return OTHER
+        ext = extension(parts.path)
+        if ext in NON_HTML_EXTENSIONS:
+            return OTHER
+        if not ext or ext in HTML_EXTENSIONS:
+            return HTML
+        return None
+
+    def observe(self, url, mime_type):
+        """Remember that url gave content of mime_type"""
+        parts = parse_url(url)
+        key = (parts.host, path_pattern(parts.path))
+        counts = self._seen.get(key)
+        if counts is None:
+            if len(self._seen) >= self.max_patterns:
+                return
+            counts = self._seen[key] = [0, 0]
+        counts[0 if mime_type == "text/html" else 1] += 1
+
+    def __len__(self):
+        return len(self._seen)
@@ -11,20 +11,54 @@
 
 import re
 import sys
+import base64
+import codecs
+import zlib
+import multiprocessing
+import hashlib
+import heapq
+import random
 import time
 import logging
 import math
 import urllib
 import urllib.error
 import urllib.request
+import http.client
+import socket
+import threading
 from urllib.parse import urlparse
 import optparse
 #import hashlib
-from html import escape
+from html import unescape
 #from traceback import format_exc
-from queue import Queue, Empty as QueueEmpty
-
-from bs4 import BeautifulSoup
+from queue import Empty as QueueEmpty
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import brotli                                   # Optional, for Content-Encoding: br
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+if brotli is not None:
+    try:
+        # ContentDecoder has to limit the output, which older versions can't
+        brotli.Decompressor().process(b"", output_buffer_limit=1)
+    except TypeError:
+        brotli = None
+
+from urlfilter import parse_url, PrefixTrie, HostRule, UrlCanonicalizer, CANONICAL_RULES, DEFAULT_CANONICAL_RULES, STRIP_PARAMS
+from httpcache import ResponseCache
+from dnscache import DnsCache
+from contenttype import ContentTypePredictor, OTHER
+from scheduler import HostScheduler, RobotsCache, CircuitBreaker
+from metrics import CrawlMetrics, FetchTimings
+from output import NdjsonWriter
+from warc import WarcWriter, response_record, shard_path
+from frontier import FifoQueue, PriorityQueue, DiskState, SEEN_SET_KINDS, CRAWL_ORDERS, seen_set, memory_bytes
 
 __version__ = "0.2"
 
@@ -33,6 +67,23 @@ VERSION = "%prog v" + __version__
 
 AGENT = "%s/%s" % (__name__, __version__)
 
+MAX_REDIRECTS = 5
+MAX_BODY_SIZE = 10 * 1024 * 1024                    # Default maximum page size in bytes
+CHUNK_SIZE = 64 * 1024                              # Bytes read from a response at a time
+CHECKPOINT_SECONDS = 60                             # Default time between saves of the crawl state
+RETRY_DELAY = 1                                     # Seconds before the first retry of a failed fetch, doubled for every next one
+
+# Content encodings the Fetcher asks for (brotli only if brotli 1.2 or later is installed)
+CONTENT_ENCODINGS = ("gzip", "deflate", "br") if brotli is not None else ("gzip", "deflate")
+
+LOGFORMAT = "%(levelname)s: %(asctime)s: %(message)s"
+
+# Counters that are saved by a checkpoint and added up over the shards of a
+# multi-process crawl
+COUNTERS = ("num_links", "num_followed", "num_failed_links", "num_robots_excluded", "num_not_modified",
+            "num_bytes_received", "num_bytes_decoded", "num_fetches_saved", "num_retries", "num_host_skipped",
+            "num_type_skipped", "num_head_skipped")
+
 class Link (object):
 
     def __init__(self, src, dst, link_type):
@@ -53,35 +104,121 @@ class Link (object):
 
 class Crawler(object):
 
-    def __init__(self, root, depth_limit, fetch_timeout, confine = None, exclude = [], locked = True, filter_seen = True):
-        self.root = root
-        self.host = urlparse(root).netloc
+    def __init__(self, root, depth_limit, fetch_timeout, confine = None, exclude = [], locked = True, filter_seen = True,
+                 workers = 1, host_workers = 2, max_body_size = MAX_BODY_SIZE, state = None, seen = "set",
+                 seen_error_rate = 0.001, delay = 0, robots = True, cache = None, shard = None, order = "bfs",
+                 max_pages = None, compress = True, output = None, canonical_rules = DEFAULT_CANONICAL_RULES,
+                 strip_params = STRIP_PARAMS, retries = 2, retry_budget = 0.1, host_failures = 5,
+                 host_cooldown = 30, dns_ttl = 300, predict_types = True, head_probe = False, warc = None):
+        # URLs are rewritten to a canonical form before filtering; no
+        # rules only strips the fragment
+        self.canonicalize = UrlCanonicalizer(canonical_rules, strip_params) if canonical_rules else None
+
+        self.root = self.canonicalize(root) if self.canonicalize is not None else root
+        self.host = urlparse(self.root).netloc
+        # The confine and exclude prefixes are matched against canonical
+        # URLs, so they are rewritten as well, with the rules that leave a
+        # prefix of a URL a prefix of its canonical form
+        prefix_rules = [rule for rule in ("case", "port", "dots") if self.canonicalize is not None and rule in canonical_rules]
+        if prefix_rules:
+            canonical_prefix = UrlCanonicalizer(prefix_rules)
+            confine = canonical_prefix(confine) if confine is not None else None
+            exclude = [canonical_prefix(prefix) for prefix in exclude]
 
         ## Data for filters:
         self.depth_limit = depth_limit              # Max depth (number of hops from root)
         self.confine_prefix = confine               # Limit search to this prefix
         self.exclude_prefixes = exclude;            # URL prefixes NOT to visit
         self.locked = locked;                       # Limit crawl to the same host as the originating URL   
-
-        self.urls_seen = set()                      # Used to avoid putting duplicates in queue (all mimetypes)
-        self.hosts_seen = set()                     # Used to keep track of hosts
-        self.visited_links = set()                  # Used to avoid re-processing a page
-
-        self.urls_remembered = set()                # For reporting to user (page URL for mimetype text/html)
-        self.links_remembered = set()               # For reporting to user (page URL -> URL)
+        self.max_pages = max_pages                  # Stop after fetching this many pages, if not None
+
+        ## Order in which queued URLs are visited, one of CRAWL_ORDERS
+        self.order = order
+
+        ## Crawl state, in memory or (if a DiskState is given) on disk:
+        self.state = state
+        if state is None:
+            self.queue = FifoQueue() if order == "bfs" else PriorityQueue() # URLs (and their depth) waiting to be visited
+            self.urls_seen = seen_set(seen, error_rate=seen_error_rate) # Used to avoid putting duplicates in queue (all mimetypes)
+            self.spellings_seen = seen_set(seen, error_rate=seen_error_rate) # Used to count fetches saved by canonicalization
+            self.hosts_seen = set()                 # Used to keep track of hosts
+            self.visited_links = seen_set(seen, error_rate=seen_error_rate) # Used to avoid re-processing a page
+
+            self.urls_remembered = set()            # For reporting to user (page URL for mimetype text/html), unless streamed
+            self.links_remembered = set()           # For reporting to user (page URL -> URL), unless streamed
+        else:
+            self.queue = state.queue() if order == "bfs" else state.priority_queue()
+            self.urls_seen = state.set("urls_seen")
+            self.spellings_seen = state.set("spellings_seen")
+            self.hosts_seen = state.set("hosts_seen")
+            self.visited_links = state.set("visited_links")
+
+            self.urls_remembered = state.set("urls_remembered")
+            self.links_remembered = state.set("links_remembered", ("src", "dst", "link_type"),
+                                              lambda l: (l.src, l.dst, l.link_type), lambda row: Link(*row))
         
         self.num_links = 0                          # Links found (and not excluded by filters)
         self.num_followed = 0                       # Links followed
         self.num_failed_links = 0                   # Links that failed for some reason
+        self.num_robots_excluded = 0                # Links not followed because of robots.txt
+        self.num_not_modified = 0                   # Pages revalidated against the cache
+        self.num_bytes_received = 0                 # Bytes of page bodies received, compressed or not
+        self.num_bytes_decoded = 0                  # Bytes of page bodies after decompression
+        self.num_fetches_saved = 0                  # Link spellings not fetched because of canonicalization
+        self.num_retries = 0                        # Fetches that were tried again after failing
+        self.num_host_skipped = 0                   # Links not followed because their host seems to be down
+        self.num_type_skipped = 0                   # Links not followed because they don't seem to be HTML
+        self.num_head_skipped = 0                   # Pages not downloaded because a HEAD request showed they aren't HTML
+        self.max_scheduled = 0                      # Most URLs taken from the queue and waiting for their host at once
+
+        self.checkpoint_seconds = CHECKPOINT_SECONDS # Time between saving the crawl state to disk
+        self._last_checkpoint = time.monotonic()
 
         self.fetch_timeout_seconds = fetch_timeout  # Timeout for fetching pages in seconds
-
-        # Pre-visit filters:  Only visit a URL if it passes these tests
-        self.pre_visit_filters=[self._prefix_ok,
+        self.max_body_size = max_body_size          # Bytes of a page that are read at most
+        self.workers = max(1, workers)              # Pages fetched at the same time
+        self.host_workers = max(1, host_workers)    # Pages fetched at the same time from a single host
+        self.delay = delay                          # Minimum seconds between requests to a single host
+        self.cache = cache                          # ResponseCache for revalidating pages, or None
+        self.shard = shard                          # Shard of a multi-process crawl, or None
+        self.compress = compress                    # Ask servers for compressed pages
+        self.resolver = DnsCache(dns_ttl)           # Host name lookups, made ahead of time where possible
+        self.output = output                        # NdjsonWriter to stream URLs and links to, or None
+        self.warc = warc                            # WarcWriter to store the pages fetched in, or None
+        # Content types are guessed from the URL and what was seen for
+        # similar URLs, so images, PDFs and the like are never requested
+        self.predictor = ContentTypePredictor() if predict_types else None
+        self.head_probe = head_probe                # Ask with HEAD first if the content type can't be guessed
+        self.print_hosts = True                     # Print every new host on standard output
+
+        self.metrics = CrawlMetrics()               # Timing histograms of all fetches
+        self.metrics_path = None                    # Where to write the metrics as JSON, if anywhere
+
+        self.scheduler = HostScheduler(self.host_workers, delay)
+        # Hosts that keep timing out or failing are left alone for a while,
+        # and skipped once they seem to be down
+        self.breaker = CircuitBreaker(host_failures, host_cooldown) if host_failures else None
+        self.max_retries = retries                  # Times a failed fetch is tried again at most
+        self.retry_budget = retry_budget            # Fraction of the pages followed that may be retries
+        self._retries = []                          # Heap of (time, url, depth, host) to fetch again
+        self._attempts = {}                         # url -> retries so far, for URLs being retried
+        self._cooling = set()                       # Hosts left alone by the circuit breaker
+        self.robots = RobotsCache(self._fetch_robots, AGENT) if robots else None
+        self._in_flight = {}                        # Fetches running, see crawl()
+
+        # Compiled forms of the settings above, used by the filters
+        self._confine_trie = PrefixTrie([confine] if confine is not None else [])
+        self._exclude_trie = PrefixTrie(exclude)
+        self._host_rule = HostRule(self.host)
+
+        # Pre-visit filters:  Only visit a URL if it passes these tests.
+        # Filters are applied in this order until one fails, so the
+        # cheap ones come first.
+        self.pre_visit_filters=[self._valid_url,
+                                self._lock_host,
+                                self._prefix_ok,
                                 self._exclude_ok,
-                                self._not_visited,
-                                self._valid_url,
-                                self._lock_host]
+                                self._not_visited]
 
         # Out-url filters: When examining a visited page, only process
         # links where the target matches these filters.        
@@ -97,12 +234,36 @@ class Crawler(object):
         visiting.  All occurrences of equivalent URLs are treated as
         identical.
 
-        All this does is strip the \"fragment\" component from URLs,
-        so that http://foo.com/blah.html\#baz becomes
-        http://foo.com/blah.html """
+        This strips the \"fragment\" component from URLs, so that
+        http://foo.com/blah.html\#baz becomes http://foo.com/blah.html,
+        and applies self.canonicalize, so that http://Foo.com:80/a/./b
+        becomes http://foo.com/a/b.
+
+        Every spelling of a URL would have been fetched separately
+        without canonicalization; the ones beyond the first are counted
+        in self.num_fetches_saved. For that, self.spellings_seen holds
+        the other spellings found, and marks the canonical URLs first
+        found in another spelling (with #variant appended; a URL found
+        never has a fragment), and those found in canonical spelling
+        after that (#canonical). """
 
         base, frag = urllib.parse.urldefrag(url)
-        return base
+        if self.canonicalize is None:
+            return base
+        canonical = self.canonicalize(base)
+        spellings = self.spellings_seen
+        if canonical != base:
+            if base not in spellings:
+                spellings.add(base)
+                if canonical in self.urls_seen:
+                    self.num_fetches_saved += 1
+                else:
+                    spellings.add(canonical + "#variant")
+        elif canonical + "#variant" in spellings and canonical + "#canonical" not in spellings:
+            # Found in canonical spelling after another one
+            spellings.add(canonical + "#canonical")
+            self.num_fetches_saved += 1
+        return canonical
 
     ## URL Filtering functions.  These all use information from the
     ## state of the Crawler to evaluate whether a given URL should be
@@ -112,12 +273,11 @@ class Crawler(object):
     def _prefix_ok(self, url):
         """Pass if the URL has the correct prefix, or none is specified"""
         return (self.confine_prefix is None  or
-                url.startswith(self.confine_prefix))
+                self._confine_trie.matches(url))
 
     def _exclude_ok(self, url):
         """Pass if the URL does not match any exclude patterns"""
-        prefixes_ok = [ not url.startswith(p) for p in self.exclude_prefixes]
-        return all(prefixes_ok)
+        return not self._exclude_trie.matches(url)
     
     def _not_visited(self, url):
         """Pass if the URL has not already been visited"""
@@ -125,16 +285,12 @@ class Crawler(object):
     
     def _valid_url(self, url):
         """Pass if the URL is a valid URL"""
-        return urlparse(url).netloc != ""
+        return parse_url(url).netloc != ""
     
     def _same_host(self, url):
-        """Pass if the URL is on the same host as the root URL"""
-        try:
-            host = urlparse(url).netloc
-            return (re.match(".*%s" % self.host, host))
-        except Exception as e:
-            logging.debug("Can't process url '%s' (%s)" % (url, e))
-            return False
+        """Pass if the URL is on the same host as the root URL, or on one
+        of its subdomains"""
+        return self._host_rule.matches(parse_url(url).host)
         
     def _lock_host(self, url):
         """Pass if host is to be locked for crawling purposes"""
@@ -155,67 +311,600 @@ class Crawler(object):
 
         new and suitable means that we don't re-visit URLs we've seen
         already fetched, and user-supplied criteria like maximum
-        search depth are checked. """
+        search depth are checked.
+
+        Fetching is done by a pool of self.workers threads. URLs taken
+        from the queue wait in a HostScheduler, which hands them out in
+        turn per host, with at most self.host_workers fetches running
+        against the same host and self.delay seconds (or the Crawl-delay
+        from robots.txt) between requests to it. Unless self.robots is
+        None, the robots.txt of a host is loaded before any page of it is
+        fetched, and disallowed URLs are skipped. Filtering and all
+        bookkeeping is done in the calling thread, so the counters and
+        sets need no locking.
+
+        Unless self.predictor is None, URLs that look like they are not
+        HTML pages are skipped without being requested; with
+        self.head_probe, URLs it can't tell about are asked for with a
+        HEAD request first.
+
+        Unless self.order is "bfs", the queue hands out the most
+        important URL found so far first (see _link_credit), and only a
+        few URLs at a time are moved to the scheduler, so that links found
+        in the meantime still count. With self.max_pages set, the crawl
+        stops after fetching that many pages.
+
+        If the crawl state is kept on disk, it is saved every
+        self.checkpoint_seconds and when the crawl ends or is interrupted.
+        A resumed crawl continues with the queue as it was saved. """
         
-        q = Queue()
-        q.put((self.root, 0))
+        q = self.queue
+        if self.state is not None and self.state.resumed:
+            self._resume()
+        elif self.shard is None or self.shard.owns(self.host):
+            q.put(self.root, 0, 1.0)
+
+        scheduler = self.scheduler
+        in_flight = self._in_flight                 # Future -> (url, depth, host), url is None for robots.txt
+        # Stop taking URLs from the queue beyond this. While a worker is
+        # idle and none of the hosts waiting is ready, up to max_waiting
+        # more are taken for every host waiting, so that the URLs of a slow
+        # host (with a long Crawl-delay) don't hold up all others; once the
+        # URLs taken are all of hosts that wait already, that stops too
+        max_waiting = 100 * self.workers if self.order == "bfs" else 2 * self.workers
 
-        while not q.empty():
-            this_url, depth = q.get()
-            logging.debug("Got %s from queue to process with depth %d" % (this_url, depth))
-            
-            logging.info("Following link %d (of which %d have failed)" % (self.num_followed, self.num_failed_links))
-            
-            #Non-URL-specific filter: Discard anything over depth limit
-            if depth > self.depth_limit:
-                logging.debug("Will not process any further because depth %d > depth limit %d" % (depth, self.depth_limit))
-                break # if there's a chance depth will get less for future links, use continue instead
-            
-            #Apply URL-based filters.
-            do_not_follow = [f for f in self.pre_visit_filters if not f(this_url)]
-
-            #If no filters failed (that is, all passed), process URL
-            if do_not_follow == []:
-                logging.info("Processing %s on depth %d" % (this_url, depth))
-                try:
-                    self.visited_links.add(this_url)
-                    this_host = urlparse(this_url).netloc
-
-                    if this_host not in self.hosts_seen:
-                        self.hosts_seen.add(this_host)
-                        logging.info("New host %s encountered" % this_host)
-                        print(this_host)
-                        
-                    self.num_followed += 1
-                    page = Fetcher(this_url, self.fetch_timeout_seconds)
-                    
-                    page.fetch()
-                    added_links = 0
-                    for link_url in [self._pre_visit_url_condense(l) for l in page.out_links()]:
-                        if (link_url not in self.urls_seen):
-                            q.put((link_url, depth + 1))
-                            added_links += 1
-                            self.urls_seen.add(link_url)
-                            
-                        do_not_remember = [f for f in self.out_url_filters if not f(link_url)]
-                        if do_not_remember == []:
-                            self.num_links += 1
-                            self.urls_remembered.add(link_url) # url
-                            link = Link(this_url, link_url, "href")
-                            if link not in self.links_remembered:
-                                self.links_remembered.add(link) # page -> url
-
-                    if page.fetch_failed:
-                        self.num_failed_links += 1
-                        logging.warning("Fetching page %s did not work out" % this_url)
-                    else:
-                        logging.debug("Added %d links for depth %d" % (added_links, depth + 1))
-
-                except Exception as e:
-                    logging.debug("Can't process url '%s' (%s)" % (this_url, e))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+
+                while True:
+                    if self.shard is not None:
+                        self._receive(q)
+                    if self._retries:
+                        self._requeue(q)
+                    budget_spent = self._budget_spent()
+                    if not in_flight and (budget_spent or (q.empty() and not len(scheduler) and not self._retries)):
+                        # In a sharded crawl, wait until all shards are out of work
+                        if self.shard is None or self.shard.wait():
+                            break
+                        continue
+
+                    while not budget_spent and not q.empty() and (len(scheduler) < max_waiting or
+                                                                  (len(in_flight) < self.workers and not scheduler.ready() and
+                                                                   len(scheduler) < max_waiting * (1 + scheduler.num_hosts()))):
+                        this_url, depth = q.get()
+                        logging.debug("Got %s from queue to process with depth %d" % (this_url, depth))
+
+                        this_host = self._accept(this_url, depth)
+                        if this_host is None:
+                            q.done(this_url)
+                            continue
+
+                        if self.robots is not None and self.robots.needs_load(this_host) and not scheduler.is_blocked(this_host):
+                            scheduler.block(this_host)
+                            future = pool.submit(self.robots.load, parse_url(this_url).scheme, this_host)
+                            in_flight[future] = (None, None, this_host)
+                        scheduler.add(this_url, depth, this_host)
+                        self.max_scheduled = max(self.max_scheduled, len(scheduler))
+
+                    while len(in_flight) < self.workers and not self._budget_spent():
+                        item = scheduler.next()
+                        if item is None:
+                            break
+                        this_url, depth, this_host = item
+                        self._visit(this_url, depth, this_host)
+                        probe = self.head_probe and self.predictor is not None and self.predictor.predict(this_url) is None
+                        in_flight[pool.submit(self._fetch, this_url, probe)] = item
+
+                    if not in_flight:
+                        if (len(scheduler) or self._retries) and not self._budget_spent():
+                            if self._cooling:
+                                # Waiting for failing hosts is all that is left
+                                self._end_cooldowns()
+                            else:
+                                time.sleep(self._wakeup() or 0)
+                        continue
+
+                    done, _ = wait(in_flight, timeout=self._wakeup(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        this_url, depth, this_host = in_flight.pop(future)
+                        if this_url is None:
+                            self._robots_loaded(this_host, future, q)
+                            continue
+                        scheduler.done(this_host)
+                        try:
+                            page = future.result()
+                            if self._fetch_again(this_url, depth, this_host, page, q):
+                                continue
+                            self._process_page(this_url, depth, page, q)
+                        except Exception as e:
+                            logging.debug("Can't process url '%s' (%s)" % (this_url, e))
+                        q.done(this_url)
+
+                    if self.shard is not None:
+                        self.shard.flush()
+                    if time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds:
+                        self.checkpoint()
+
+            if self._budget_spent():
+                logging.info("Page budget used up, %d URLs left in the queue" % (len(q) + len(scheduler)))
+        finally:
+            self.resolver.close()
+            self.checkpoint()
+
+    def _wakeup(self):
+        """Seconds until a host becomes ready or a retry is due, or None"""
+        wakeup = self.scheduler.wakeup()
+        if self._retries:
+            due = max(0, self._retries[0][0] - time.monotonic())
+            wakeup = due if wakeup is None else min(wakeup, due)
+        return wakeup
+
+    def _fetch_again(self, this_url, depth, this_host, page, q):
+
+        """ Keep track of the failures of this_host. Returns True if the
+        fetch of this_url failed in a way that may pass (a timeout, a
+        connection problem or a server error) and it will be retried.
+
+        Retries wait RETRY_DELAY seconds, twice as long for every next
+        retry, and no longer happen once self.retry_budget is used up.
+        When the circuit breaker of this_host trips, its URLs are put off
+        or, if it seems to be down, skipped. """
+
+        if not page.retryable:
+            if self.breaker is not None:
+                self.breaker.success(this_host)
+                self._cooling.discard(this_host)
+            self._attempts.pop(this_url, None)
+            return False
 
+        # Only the first failure of a URL counts against its host: a few
+        # bad URLs that keep failing are not a sign that the host is down
+        pause = None
+        if self.breaker is not None and this_url not in self._attempts:
+            pause = self.breaker.failure(this_host)
+        if pause is not None:
+            if self.breaker.is_down(this_host):
+                logging.warning("Host %s seems to be down, skipping its URLs" % this_host)
+                self._cooling.discard(this_host)
+                for url in self.scheduler.remove_if(this_host, lambda url: True):
+                    self.num_host_skipped += 1
+                    q.done(url)
+                self._attempts.pop(this_url, None)
+                return False
+            logging.warning("Host %s keeps failing, leaving it alone for %d seconds" % (this_host, pause))
+            self.scheduler.defer(this_host, pause)
+            self._cooling.add(this_host)
+
+        attempt = self._attempts.get(this_url, 0)
+        if attempt >= self.max_retries or self.num_retries >= max(10, self.retry_budget * self.num_followed):
+            self._attempts.pop(this_url, None)
+            return False
+
+        self.metrics.record(this_host, page.timings, True)
+        self._attempts[this_url] = attempt + 1
+        self.num_retries += 1
+        delay = max(RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5), pause or 0)
+        logging.debug("Fetching %s failed, retrying in %0.1f seconds" % (this_url, delay))
+        heapq.heappush(self._retries, (time.monotonic() + delay, this_url, depth, this_host))
+        return True
+
+    def _end_cooldowns(self):
+        """Give the failing hosts their next try now. When nothing else is
+        left to do, waiting for them would only add to the crawl time."""
+        now = time.monotonic()
+        for host in self._cooling:
+            logging.info("Nothing left to do but wait for %s, trying it again now" % host)
+            self.breaker.end_cooldown(host)
+            self.scheduler.expedite(host, now)
+        self._retries = [(now if host in self._cooling else t, url, depth, host) for t, url, depth, host in self._retries]
+        heapq.heapify(self._retries)
+        self._cooling.clear()
+
+    def _requeue(self, q):
+        """Hand the retries that are due to the scheduler"""
+        now = time.monotonic()
+        while self._retries and self._retries[0][0] <= now:
+            t, url, depth, host = heapq.heappop(self._retries)
+            if self.breaker is not None and self.breaker.is_down(host):
+                self.num_host_skipped += 1
+                self._attempts.pop(url, None)
+                q.done(url)
             else:
-                logging.debug("Will not process because rejected by filters")
+                self.scheduler.add(url, depth, host)
+
+    def _budget_spent(self):
+        """Whether self.max_pages pages have been fetched (by all shards
+        together, in a sharded crawl)"""
+        if self.shard is not None and self.shard.pages_left is not None:
+            return self.shard.budget_spent()
+        return self.max_pages is not None and self.num_followed >= self.max_pages
+
+    def _receive(self, q):
+        """Queue the URLs other shards found for this one"""
+        for url, depth in self.shard.receive():
+            if url not in self.urls_seen:
+                self.urls_seen.add(url)
+                q.put(url, depth)
+                self.resolver.prefetch_url(url)
+
+    def _robots_loaded(self, host, future, q):
+        """Store the robots.txt of host and drop the waiting URLs it disallows"""
+        try:
+            self.robots.store(host, future.result())
+        except Exception as e:
+            logging.debug("Can't process robots.txt of %s (%s)" % (host, e))
+            self.scheduler.unblock(host)
+            return
+        for url in self.scheduler.remove_if(host, lambda url: not self.robots.allowed(host, url)):
+            logging.debug("Will not process %s because of robots.txt" % url)
+            self.num_robots_excluded += 1
+            q.done(url)
+        self.scheduler.unblock(host, self.robots.crawl_delay(host))
+
+    def _resume(self):
+        """Continue a crawl from its saved state. URLs that were waiting or
+        being fetched when the state was saved are still queued; forget
+        that they were visited so they are fetched again."""
+        for name, value in self.state.load_counters().items():
+            setattr(self, name, value)
+        for url in self.queue:
+            self.visited_links.discard(url)
+        logging.info("Resuming crawl with %d URLs in the queue" % len(self.queue))
+
+    def checkpoint(self):
+        """Save the crawl state, if it is kept on disk. Pages being fetched
+        or waiting to be retried are not counted as followed yet, they are
+        fetched again when the crawl is resumed."""
+        self._last_checkpoint = time.monotonic()
+        if self.state is not None:
+            counters = {name: getattr(self, name) for name in COUNTERS}
+            fetching = sum(1 for url, depth, host in self._in_flight.values() if url is not None)
+            counters["num_followed"] -= fetching + len(self._retries)
+            self.state.checkpoint(counters)
+            logging.info("Crawl state saved to %s" % self.state.path)
+        if self.metrics_path is not None:
+            self.metrics.dump(self.metrics_path)
+        if self.output is not None:
+            self.output.flush()
+        if self.warc is not None:
+            self.warc.flush()
+        self.log_queue_depths()
+
+    def log_queue_depths(self, top = 10):
+        """Log the hosts with the most URLs waiting"""
+        depths = self.scheduler.queue_depths()
+        if depths:
+            busiest = sorted(depths.items(), key=lambda x: x[1], reverse=True)[:top]
+            logging.info("URLs waiting per host: %s" % ", ".join("%s %d" % d for d in busiest))
+
+    def _accept(self, this_url, depth):
+
+        """ Decide whether this_url should be fetched. If so, mark it as
+        visited and return its host; otherwise return None. """
+
+        #Non-URL-specific filter: Discard anything over depth limit
+        if depth > self.depth_limit:
+            # Pages are fetched concurrently, so the queue is only roughly
+            # ordered by depth and URLs behind this one may still be in range
+            logging.debug("Will not process because depth %d > depth limit %d" % (depth, self.depth_limit))
+            return None
+
+        #Apply URL-based filters.
+        #If any filter failed, do not process URL
+        if not all(f(this_url) for f in self.pre_visit_filters):
+            logging.debug("Will not process because rejected by filters")
+            return None
+
+        this_host = parse_url(this_url).netloc
+        if self.robots is not None and not self.robots.allowed(this_host, this_url):
+            logging.debug("Will not process because of robots.txt")
+            self.num_robots_excluded += 1
+            return None
+
+        if self.breaker is not None and self.breaker.is_down(this_host):
+            logging.debug("Will not process because host %s seems to be down" % this_host)
+            self.num_host_skipped += 1
+            return None
+
+        if self.predictor is not None and self.predictor.predict(this_url) == OTHER:
+            logging.debug("Will not process because it does not seem to be HTML")
+            self.num_type_skipped += 1
+            return None
+
+        self.visited_links.add(this_url)
+        return this_host
+
+    def _visit(self, this_url, depth, this_host):
+        """Bookkeeping for a page that is about to be fetched"""
+        if this_url in self._attempts:
+            logging.info("Retrying %s (retry %d)" % (this_url, self._attempts[this_url]))
+            return
+        logging.info("Following link %d (of which %d have failed)" % (self.num_followed, self.num_failed_links))
+        logging.info("Processing %s on depth %d" % (this_url, depth))
+
+        if this_host not in self.hosts_seen:
+            self.hosts_seen.add(this_host)
+            logging.info("New host %s encountered" % this_host)
+            if self.print_hosts:
+                print(this_host)
+            
+        self.num_followed += 1
+        if self.shard is not None:
+            self.shard.page_fetched()
+
+    def _fetch(self, this_url, probe = False):
+        """Fetch a single page, after a HEAD request if probe is True. Runs
+        in a worker thread."""
+        page = Fetcher(this_url, self.fetch_timeout_seconds, self.max_body_size, self.cache, self.compress, self.resolver,
+                       self.warc is not None)
+        page.fetch(probe)
+        return page
+
+    def _fetch_robots(self, url):
+        """Fetch a robots.txt. Runs in a worker thread."""
+        return Fetcher(url, self.fetch_timeout_seconds, self.max_body_size, compress=self.compress,
+                       resolver=self.resolver).fetch_text()
+
+    def _link_credit(self, this_url, num_links, q):
+        """The priority each out-link of this_url adds to its target. With
+        OPIC, a page shares out the cash it collected from the pages
+        linking to it (its priority) equally over its own links; with
+        in-link counting, every link adds one."""
+        if self.order == "opic" and num_links:
+            return q.score(this_url) / num_links
+        if self.order == "inlinks":
+            return 1.0
+        return 0.0
+
+    def _process_page(self, this_url, depth, page, q):
+        """Queue and remember the out-links of a fetched page"""
+        self.metrics.record(parse_url(this_url).netloc, page.timings, page.fetch_failed)
+        added_links = 0
+        links = page.out_links()
+        credit = self._link_credit(this_url, len(links), q)
+        for link in links:
+            # One at a time, so a URL found twice on this page in different
+            # spellings is in urls_seen when the second one is condensed
+            link_url = self._pre_visit_url_condense(link)
+            new = link_url not in self.urls_seen
+            if new:
+                link_host = parse_url(link_url).netloc
+                if self.shard is None or self.shard.owns(link_host):
+                    q.put(link_url, depth + 1, credit)
+                    if depth < self.depth_limit and self._lock_host(link_url):
+                        self.resolver.prefetch_url(link_url)
+                elif depth < self.depth_limit and self._valid_url(link_url) and self._lock_host(link_url):
+                    self.shard.send(link_url, depth + 1, link_host)
+                added_links += 1
+                self.urls_seen.add(link_url)
+            elif credit:
+                q.credit(link_url, credit, depth + 1)
+                
+            if all(f(link_url) for f in self.out_url_filters):
+                self.num_links += 1
+                if self.output is not None:
+                    # A page is only processed once and has no duplicate
+                    # links, so only URLs need checking for duplicates
+                    if new:
+                        self.output.write_url(link_url)
+                    self.output.write_link(this_url, link_url, "href")
+                else:
+                    self.urls_remembered.add(link_url) # url
+                    link = Link(this_url, link_url, "href")
+                    if link not in self.links_remembered:
+                        self.links_remembered.add(link) # page -> url
+
+        if page.warc_record is not None:
+            self.warc.write(page.warc_record)
+        if self.predictor is not None and page.mime_type is not None:
+            self.predictor.observe(this_url, page.mime_type)
+        if page.head_only:
+            self.num_head_skipped += 1
+        if page.not_modified:
+            self.num_not_modified += 1
+        self.num_bytes_received += page.bytes_received
+        self.num_bytes_decoded += page.bytes_decoded
+
+        if page.fetch_failed:
+            self.num_failed_links += 1
+            logging.warning("Fetching page %s did not work out" % this_url)
+        else:
+            logging.debug("Added %d links for depth %d" % (added_links, depth + 1))
+
+class Shard(object):
+
+    """One process of a multi-process crawl. Every host belongs to exactly
+    one shard, chosen by a hash of the host name, so each shard keeps its
+    own queue and seen-sets and is the only one fetching from its hosts.
+    URLs for hosts of other shards are sent to their inbox in batches.
+
+    The crawl is over when no shard is busy and no batch is underway. A
+    shard counts a batch it sends as outstanding before it can go idle,
+    and a shard that receives a batch becomes busy before it stops
+    counting it as outstanding, so both counters can only be zero at the
+    same time once all work is done.
+
+    A page budget (--max-pages) is shared by all shards through pages_left.
+    Shards check it before they start a fetch, so together they may go over
+    it by at most one page per shard."""
+
+    BATCH = 100                                     # URLs sent to another shard at a time
+
+    def __init__(self, index, inboxes, busy, outstanding, pages_left = None):
+        self.index = index
+        self.inboxes = inboxes                      # One multiprocessing.Queue per shard
+        self.busy = busy                            # Shared number of shards that are not idle
+        self.outstanding = outstanding              # Shared number of batches sent, but not received
+        self.pages_left = pages_left                # Shared number of pages that may still be fetched, or None
+        self._outgoing = defaultdict(list)          # Shard index -> URLs (and depth) to send
+        self._received = []                         # URLs received while waiting
+        self._idle = False
+
+    @staticmethod
+    def owner(host, count):
+        # Not hash(), which differs between processes
+        return zlib.crc32(host.lower().encode("utf-8", "surrogatepass")) % count
+
+    def owns(self, host):
+        return self.owner(host, len(self.inboxes)) == self.index
+
+    def send(self, url, depth, host):
+        shard = self.owner(host, len(self.inboxes))
+        self._outgoing[shard].append((url, depth))
+        if len(self._outgoing[shard]) >= self.BATCH:
+            self._send(shard)
+
+    def _send(self, shard):
+        self._add(self.outstanding, 1)
+        self.inboxes[shard].put(self._outgoing.pop(shard))
+
+    def flush(self):
+        for shard in list(self._outgoing):
+            self._send(shard)
+
+    @staticmethod
+    def _add(counter, n):
+        with counter.get_lock():
+            counter.value += n
+
+    def budget_spent(self):
+        return self.pages_left is not None and self.pages_left.value <= 0
+
+    def page_fetched(self):
+        if self.pages_left is not None:
+            self._add(self.pages_left, -1)
+
+    def receive(self):
+        """The URLs (and depth) received since the last call, without waiting"""
+        urls, self._received = self._received, []
+        while True:
+            try:
+                batch = self.inboxes[self.index].get_nowait()
+            except QueueEmpty:
+                return urls
+            urls.extend(batch)
+            self._add(self.outstanding, -1)
+
+    def wait(self, timeout = 0.2):
+        """Called when this shard is out of work. Waits for URLs from other
+        shards (to be picked up with receive()) and returns True if the
+        whole crawl is over."""
+        self.flush()
+        if not self._idle:
+            self._idle = True
+            self._add(self.busy, -1)
+        try:
+            batch = self.inboxes[self.index].get(timeout=timeout)
+        except QueueEmpty:
+            return self.busy.value == 0 and self.outstanding.value == 0
+        self._idle = False
+        self._add(self.busy, 1)
+        self._received.extend(batch)
+        self._add(self.outstanding, -1)
+        return False
+
+
+def _crawl_shard(index, root, args, kwargs, cache_args, metrics_path, output_args, warc_path, inboxes, busy, outstanding,
+                 pages_left, results):
+    """Run one shard of a multi-process crawl and put its results on the
+    results queue, as (index, None, results), or (index, error, None) if
+    it failed"""
+    logging.basicConfig(filename='./crawler.log', level = logging.INFO, format = LOGFORMAT)
+    try:
+        results.put((index, None, _run_shard(index, root, args, kwargs, cache_args, metrics_path, output_args, warc_path,
+                                             inboxes, busy, outstanding, pages_left)))
+    except BaseException as e:
+        logging.exception("Shard %d failed" % index)
+        results.put((index, "%s: %s" % (type(e).__name__, e), None))
+        raise
+
+
+def _run_shard(index, root, args, kwargs, cache_args, metrics_path, output_args, warc_path, inboxes, busy, outstanding,
+               pages_left):
+    cache = ResponseCache(*cache_args) if cache_args else None
+    output = None
+    warc = None
+    try:
+        if output_args:
+            path, urls, links = output_args
+            output = NdjsonWriter("%s.%d" % (path, index), urls, links)
+        warc = WarcWriter(shard_path(warc_path, index), software=AGENT) if warc_path else None
+        crawler = Crawler(root, *args, cache=cache, shard=Shard(index, inboxes, busy, outstanding, pages_left),
+                          output=output, warc=warc, **kwargs)
+        if metrics_path is not None:
+            crawler.metrics_path = "%s.%d" % (metrics_path, index)
+        crawler.crawl()
+    finally:
+        Fetcher.pool.close()
+        if cache is not None:
+            cache.close()
+        if output is not None:
+            output.close()
+        if warc is not None:
+            warc.close()
+    logging.info("Shard %d followed %d links over %d connections" % (index, crawler.num_followed, Fetcher.pool.num_created))
+    counters = {name: getattr(crawler, name) for name in COUNTERS}
+    links = [(l.src, l.dst, l.link_type) for l in crawler.links_remembered]
+    return counters, list(crawler.urls_remembered), links
+
+
+def crawl_sharded(processes, root, *args, cache_args = None, metrics_path = None, output_args = None, warc_path = None,
+                  **kwargs):
+    """Crawl with the given number of processes, each a Crawler created with
+    root, args and kwargs, and owning a share of the hosts. cache_args are
+    the arguments for a ResponseCache that each process opens itself.
+    output_args are (path, urls, links) for an NdjsonWriter per process,
+    writing to path with the number of the process appended. Likewise,
+    each process writes its own WARC file if warc_path is given.
+
+    Returns a Crawler (that has not crawled itself) holding the merged
+    results and counters of all processes. If a process fails or dies,
+    the others can't finish the crawl (the hosts of the failed one are
+    never crawled): they are stopped and RuntimeError is raised."""
+    inboxes = [multiprocessing.Queue() for i in range(processes)]
+    busy = multiprocessing.Value("i", processes)
+    outstanding = multiprocessing.Value("i", 0)
+    max_pages = kwargs.get("max_pages")
+    pages_left = multiprocessing.Value("i", max_pages) if max_pages is not None else None
+    results = multiprocessing.Queue()
+    shards = [multiprocessing.Process(target=_crawl_shard, args=(i, root, args, kwargs, cache_args, metrics_path, output_args,
+                                                                 warc_path, inboxes, busy, outstanding, pages_left, results))
+              for i in range(processes)]
+    for p in shards:
+        p.start()
+
+    merged = Crawler(root, *args, **kwargs)
+    error = None
+    try:
+        finished = set()
+        while len(finished) < processes and error is None:
+            try:
+                index, error, result = results.get(timeout=1)
+            except QueueEmpty:
+                # A process that was killed can't report that it failed
+                for i, p in enumerate(shards):
+                    if i not in finished and p.exitcode not in (None, 0) and results.empty():
+                        index, error = i, "exited with code %d" % p.exitcode
+                        break
+                continue
+            finished.add(index)
+            if error is not None:
+                break
+            counters, urls, links = result
+            for name, value in counters.items():
+                setattr(merged, name, getattr(merged, name) + value)
+            merged.urls_remembered.update(urls)
+            merged.links_remembered.update(Link(*l) for l in links)
+    finally:
+        if error is not None:
+            for p in shards:
+                p.terminate()
+        for p in shards:
+            p.join()
+    if error is not None:
+        raise RuntimeError("Shard %d of the crawl failed (%s)" % (index, error))
+    return merged
+
 
 class OpaqueDataException (Exception):
     def __init__(self, message, mimetype, url):
@@ -224,79 +913,570 @@ class OpaqueDataException (Exception):
         self.url = url
         
 
+class LinkExtractor(object):
+
+    """Finds the href of every <a> tag in an HTML document that is fed to it
+    in pieces, so links can be extracted while the page is still coming in.
+
+    Only the constructs that matter for finding links are recognised: <a>
+    and <base> tags, comments, and the raw text of <script> and <style>
+    elements (which may contain things that look like tags). Everything else
+    is skipped without being parsed, which is what makes this a lot cheaper
+    than building a document tree. Unconsumed input is kept only from the
+    start of a construct that is not complete yet."""
+
+    _START = re.compile(r"<(?:!--|(a|base|script|style)(?=[\s/>]))", re.I)
+    _TAG = re.compile(r"""<[a-zA-Z][^\s/>]*((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+    _HREF = re.compile(r"""(?:^|[\s/])href(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?(?=[\s/>]|$)""", re.I)
+    _END = {"script": re.compile(r"</script\s*>", re.I),
+            "style": re.compile(r"</style\s*>", re.I)}
+    _MAX_TAG = 8192                                 # Longest tag (in characters) that is waited for
+
+    def __init__(self):
+        self.base = None                            # Value of the first <base href>, if any
+        self.hrefs = []                             # Values of <a href> in document order
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        self._scan(final=False)
+
+    def close(self):
+        self._scan(final=True)
+        self._buffer = ""
+
+    def _scan(self, final):
+        buf = self._buffer
+        pos = 0
+        while True:
+            m = self._START.search(buf, pos)
+            if m is None:
+                # Keep a few characters in case a tag name is split over two pieces
+                pos = len(buf) if final else max(pos, len(buf) - 7)
+                break
+            i = m.start()
+            name = m.group(1)
+            if name is None:
+                end = buf.find("-->", i + 4)
+                if end < 0:
+                    pos = len(buf) if final else i
+                    break
+                pos = end + 3
+                continue
+            tag = self._TAG.match(buf, i)
+            if tag is None:
+                if not final and len(buf) - i < self._MAX_TAG:
+                    pos = i
+                    break
+                pos = i + 1
+                continue
+            name = name.lower()
+            if name in self._END:
+                end = self._END[name].search(buf, tag.end())
+                if end is None:
+                    pos = len(buf) if final else i
+                    break
+                pos = end.end()
+                continue
+            pos = tag.end()
+            href = self._HREF.search(tag.group(1))
+            if href is None:
+                continue
+            value = unescape(next((v for v in href.groups() if v is not None), ""))
+            if name == "a":
+                self.hrefs.append(value)
+            elif self.base is None:
+                self.base = value
+        self._buffer = buf[pos:]
+
+
+class ContentDecoder(object):
+
+    """Incremental decoder for a response body sent with a Content-Encoding
+    of gzip, deflate or (if brotli 1.2 or later is installed) br."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding in ("gzip", "x-gzip"):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            # Should be a zlib stream, but some servers send raw deflate
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            self._first = True
+        elif encoding == "br" and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+        else:
+            raise ValueError("unsupported content encoding %s" % encoding)
+
+    @staticmethod
+    def for_response(response):
+        """A ContentDecoder for response, or None if its body is not encoded"""
+        encoding = (response.getheader("Content-Encoding") or "identity").strip().lower()
+        return None if encoding == "identity" else ContentDecoder(encoding)
+
+    def decompress(self, data, max_length = 0):
+        """Decoded bytes of the next piece of the body, at most max_length
+        of them if max_length is not 0. Output beyond max_length is not
+        produced at all, so a small, highly compressed body can't blow up
+        in memory."""
+        if self.encoding == "br":
+            if not max_length:
+                return self._decompressor.process(data)
+            return self._decompressor.process(data, output_buffer_limit=max_length)[:max_length]
+        if self.encoding == "deflate" and self._first:
+            self._first = False
+            try:
+                return self._decompressor.decompress(data, max_length)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data, max_length)
+
+    @property
+    def eof(self):
+        """Whether the end of the encoded body has been decoded"""
+        if self.encoding == "br":
+            return self._decompressor.is_finished()
+        return self._decompressor.eof and not self._decompressor.unconsumed_tail
+
+
+class ConnectionPool(object):
+
+    """Keeps idle persistent HTTP/1.1 connections per (scheme, host) so that
+    consecutive fetches from the same host reuse one TCP (and TLS) connection
+    instead of doing a new handshake for every page.
+
+    A connection is taken with get() and handed back with put() once its
+    response has been read completely. Connections that have been idle for
+    more than max_idle seconds are closed, and at most max_size idle
+    connections are kept over all hosts. The pool is shared between threads.
+
+    Like urllib.request, the pool goes through the proxies set in the
+    environment (http_proxy, https_proxy, no_proxy): a connection for an
+    http URL is made to the proxy, and one for an https URL is tunneled
+    through it with CONNECT."""
+
+    def __init__(self, max_size=64, max_idle=30, proxies=None):
+        self.max_size = max_size                    # Maximum number of idle connections kept
+        self.max_idle = max_idle                    # Seconds an idle connection is kept open
+        # Proxy URL by scheme, from the environment unless given
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._proxy_for = {}                        # (scheme, host) -> see proxy()
+
+        self._idle = defaultdict(list)              # (scheme, host) -> [(connection, idle since)]
+        self._num_idle = 0
+        self._lock = threading.Lock()
+
+        self.num_created = 0                        # Connections opened
+        self.num_reused = 0                         # Requests sent over an existing connection
+
+    def proxy(self, scheme, host):
+        """proxy(scheme, host) -> proxy host, headers
+
+        The proxy to reach host through, with the headers it needs (to log
+        in), or None to connect to host directly"""
+        key = (scheme, host)
+        if key not in self._proxy_for:
+            proxy = self.proxies.get(scheme)
+            if not proxy or urllib.request.proxy_bypass(host):
+                self._proxy_for[key] = None
+            else:
+                parts = urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+                headers = {}
+                if parts.username is not None:
+                    credentials = "%s:%s" % (urllib.parse.unquote(parts.username),
+                                             urllib.parse.unquote(parts.password or ""))
+                    headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+                self._proxy_for[key] = (parts.netloc.rpartition("@")[2], headers)
+        return self._proxy_for[key]
+
+    def get(self, scheme, host, timeout):
+        """get(scheme, host, timeout) -> connection, reused"""
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            while idle:
+                connection, since = idle.pop()
+                self._num_idle -= 1
+                if now - since <= self.max_idle:
+                    self.num_reused += 1
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+            self.num_created += 1
+        proxy = self.proxy(scheme, host)
+        if proxy is not None:
+            proxy_host, headers = proxy
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(proxy_host, timeout=timeout)
+                connection.set_tunnel(host, headers=headers)
+                return connection, False
+            return http.client.HTTPConnection(proxy_host, timeout=timeout), False
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=timeout), False
+        return http.client.HTTPConnection(host, timeout=timeout), False
+
+    def put(self, scheme, host, connection):
+        """Hand back a connection whose response has been read completely"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if self._num_idle >= self.max_size:
+                connection.close()
+                return
+            self._idle[(scheme, host)].append((connection, now))
+            self._num_idle += 1
+
+    def _evict(self, now):
+        for key in list(self._idle):
+            idle = self._idle[key]
+            fresh = [(c, since) for c, since in idle if now - since <= self.max_idle]
+            for c, since in idle:
+                if now - since > self.max_idle:
+                    c.close()
+            self._num_idle -= len(idle) - len(fresh)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, since in idle:
+                    connection.close()
+            self._idle.clear()
+            self._num_idle = 0
+
+
 class Fetcher(object):
     
     """The name Fetcher is a slight misnomer: This class retrieves and interprets web pages."""
 
-    def __init__(self, url, fetch_timeout):
+    pool = ConnectionPool()                         # Persistent connections, shared by all fetchers
+    resolver = DnsCache()                           # Host name lookups, shared by fetchers of no crawler
+
+    def __init__(self, url, fetch_timeout, max_body_size = MAX_BODY_SIZE, cache = None, compress = True, resolver = None,
+                 warc = False):
         self.url = url
-        self.out_urls = []
+        self.out_urls = {}                          # Out-link URLs as keys, in the order they were found
 
         self.fetch_timeout_seconds = fetch_timeout  # Timeout for fetching pages in seconds
+        self.max_body_size = max_body_size          # Bytes of a page that are read at most
+        self.cache = cache                          # ResponseCache to revalidate against, or None
+        self.compress = compress                    # Ask for a compressed response (see CONTENT_ENCODINGS)
+        if resolver is not None:
+            self.resolver = resolver                # DnsCache to use instead of the shared one
+        self.warc = warc                            # Keep the page as a compressed WARC record
+        self.bytes_received = 0                     # Bytes of the page body as sent by the server
+        self.bytes_decoded = 0                      # Bytes of the page body after decompression
         self.fetch_failed = False                   # Set to True if fetching a page failed
+        self.retryable = False                      # Set to True if it failed in a way that may pass
+        self.not_modified = False                   # Set to True if the out-links came from the cache
+        self.head_only = False                      # Set to True if a HEAD request showed it is not HTML
+        self.mime_type = None                       # Content type of the response, if there was one
+        self.warc_record = None                     # The page as a WARC record (see warc.py), if self.warc
+        self.timings = FetchTimings()               # Time spent per stage of the fetch
 
     def __getitem__(self, x):
-        return self.out_urls[x]
+        return list(self.out_urls)[x]
+
+    def __contains__(self, url):
+        return url in self.out_urls
+
+    def __iter__(self):
+        return iter(self.out_urls)
+
+    def __len__(self):
+        return len(self.out_urls)
 
     def out_links(self):
-        return self.out_urls
+        return list(self.out_urls)
+
+    def add_out_links(self, base, hrefs):
+        """Resolve hrefs against base and add the ones not seen before.
+        The hrefs are as LinkExtractor found them, with HTML character
+        references already replaced, so &amp; in a page is & here."""
+        start = time.perf_counter()
+        for href in hrefs:
+            url = urllib.parse.urljoin(base, href)
+            if url not in self.out_urls:
+                self.out_urls[url] = None
+        self.timings.add("extract", time.perf_counter() - start)
+
+    def _addHeaders(self, headers):
+        headers["User-Agent"] = AGENT
+        if self.compress:
+            headers["Accept-Encoding"] = ", ".join(CONTENT_ENCODINGS)
+
+    def _create_connection(self, address, timeout = None, source_address = None):
+        """Open a socket to address like socket.create_connection does,
+        looking up the host in the shared DnsCache and timing the lookup
+        separately."""
+        host, port = address
+        start = time.perf_counter()
+        addresses = self.resolver.resolve(host, port)
+        self.timings.add("dns", time.perf_counter() - start)
+        error = OSError("getaddrinfo returned an empty list")
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        raise error
+
+    def _connect(self, connection):
+        """Connect a new connection, timing the DNS and connect stages"""
+        connection._create_connection = self._create_connection
+        dns = self.timings.seconds["dns"]
+        start = time.perf_counter()
+        connection.connect()
+        self.timings.add("connect", time.perf_counter() - start - (self.timings.seconds["dns"] - dns))
+
+    def _request(self, parts, extra_headers = None, method = "GET"):
+        """Send a GET (or other method) request for the (split) URL parts over a pooled
+        connection. A reused connection may have been closed by the server
+        in the meantime; in that case the request is sent once more over a
+        new connection."""
+        target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        headers = dict(extra_headers or {})
+        self._addHeaders(headers)
+        proxy = self.pool.proxy(parts.scheme, parts.netloc)
+        if proxy is not None and parts.scheme == "http":
+            # A proxy for plain HTTP is sent the whole URL
+            target = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or "/", parts.query, ""))
+            headers.update(proxy[1])
+        while True:
+            connection, reused = self.pool.get(parts.scheme, parts.netloc, self.fetch_timeout_seconds)
+            try:
+                if connection.sock is None:
+                    self._connect(connection)
+                start = time.perf_counter()
+                connection.request(method, target, headers=headers)
+                response = connection.getresponse()
+                self.timings.add("ttfb", time.perf_counter() - start)
+                return connection, response
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                logging.debug("Connection to %s went stale, reconnecting" % parts.netloc)
+
+    def _release(self, parts, connection, response):
+        """Return the connection to the pool if the response allows it"""
+        if response.isclosed() and not response.will_close:
+            self.pool.put(parts.scheme, parts.netloc, connection)
+        else:
+            connection.close()
 
-    def _addHeaders(self, request):
-        request.add_header("User-Agent", AGENT)
+    def _open(self, extra_headers = None, method = "GET"):
+        """_open() -> url, parts, connection, response
 
-    def _open(self):
+        Request self.url with method, following redirects. extra_headers are only sent
+        with the request for self.url itself, not to where it redirects.
+        HTTP errors are raised as urllib.error.HTTPError and connection
+        problems as urllib.error.URLError, like urllib.request does."""
         url = self.url
-        logging.debug("Attempt to connect to %s" % urlparse(url).netloc)
         try:
-            request = urllib.request.Request(url)
-            handle = urllib.request.build_opener()
-        except IOError:
-            logging.debug("Error opening %s" % url)
+            for _ in range(MAX_REDIRECTS + 1):
+                parts = urllib.parse.urlsplit(url)
+                if parts.scheme not in ("http", "https"):
+                    raise urllib.error.URLError("unknown url type: %s" % parts.scheme)
+                logging.debug("Attempt to connect to %s" % parts.netloc)
+                connection, response = self._request(parts, extra_headers if url == self.url else None, method)
+                logging.debug("Successfullly opened %s" % parts.netloc)
+
+                location = response.getheader("Location")
+                if response.status in (301, 302, 303, 307, 308) and location:
+                    response.read()
+                    self._release(parts, connection, response)
+                    url = urllib.parse.urljoin(url, location)
+                    continue
+                if response.status >= 400:
+                    response.read()
+                    self._release(parts, connection, response)
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, None)
+                return url, parts, connection, response
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            if isinstance(e, urllib.error.URLError):
+                raise
+            raise urllib.error.URLError(e)
+        raise urllib.error.URLError("too many redirects for %s" % self.url)
+
+    def _read(self, response):
+        """Stream the body of response into a LinkExtractor, decompressing
+        it on the way if it has a Content-Encoding, and stopping after
+        self.max_body_size (decompressed) bytes. Returns the extractor,
+        whether the whole body was read, a SHA-256 hash of what was read,
+        after decompression, and (only with self.warc) what was read."""
+        extractor = LinkExtractor()
+        body = [] if self.warc else None
+        content = ContentDecoder.for_response(response)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        content_hash = hashlib.sha256()
+        remaining = self.max_body_size
+        complete = True
+        timings = self.timings
+        while True:
+            start = time.perf_counter()
+            chunk = response.read(CHUNK_SIZE if content is not None else min(CHUNK_SIZE, remaining))
+            decoding = time.perf_counter()
+            timings.add("download", decoding - start)
+            if not chunk:
+                break
+            self.bytes_received += len(chunk)
+            if content is not None:
+                chunk = content.decompress(chunk, remaining)
+            self.bytes_decoded += len(chunk)
+            if body is not None:
+                body.append(chunk)
+            content_hash.update(chunk)
+            text = decoder.decode(chunk)
+            extracting = time.perf_counter()
+            timings.add("decode", extracting - decoding)
+            extractor.feed(text)
+            timings.add("extract", time.perf_counter() - extracting)
+            remaining -= len(chunk)
+            if remaining <= 0:
+                complete = (content is None or content.eof) and response.read(1) == b""
+                if not complete:
+                    logging.debug("Page %s is larger than %d bytes, ignoring the rest" % (self.url, self.max_body_size))
+                break
+        extractor.feed(decoder.decode(b"", final=True))
+        extractor.close()
+        return extractor, complete, content_hash.hexdigest(), b"".join(body) if body is not None else None
+
+    def fetch_text(self):
+        """fetch_text() -> status, text
+
+        Fetch self.url as text, without looking for links. The status is
+        0 if the URL could not be fetched at all."""
+        try:
+            url, parts, connection, response = self._open()
+            content = ContentDecoder.for_response(response)
+            body = response.read(self.max_body_size)
+            complete = response.read(1) == b""
+            if complete:
+                self._release(parts, connection, response)
+            else:
+                connection.close()
+            if content is not None:
+                body = content.decompress(body, self.max_body_size)
+            return response.status, body.decode("utf-8", errors="replace")
+        except urllib.error.HTTPError as error:
+            return error.code, ""
+        except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError, zlib.error) as error:
+            logging.debug("Error %s while fetching" % error)
+            return 0, ""
+
+    def probe(self):
+        """Ask for the content type of self.url with a HEAD request.
+        Returns None if the server did not answer it; not every server
+        allows HEAD."""
+        try:
+            url, parts, connection, response = self._open(method="HEAD")
+        except urllib.error.URLError as error:
+            logging.debug("Error %s while probing" % error)
             return None
-        logging.debug("Successfullly opened %s" % urlparse(url).netloc)
-        return (request, handle)
+        response.read()
+        self._release(parts, connection, response)
+        return response.msg.get_content_type()
+
+    def fetch(self, probe = False):
+        """Fetch self.url and find its out-links. With probe True, a HEAD
+        request is sent first and the page is not downloaded if it is not
+        HTML."""
+        self.timings = FetchTimings()
+        try:
+            self._fetch(probe)
+        finally:
+            self.timings.finish()
 
-    def fetch(self):
-        request, handle = self._open()
-        self._addHeaders(request)
+    def _fetch(self, probe = False):
         self.fetch_failed = False
-        if handle:
+        self.retryable = False
+        self.not_modified = False
+        self.head_only = False
+        self.mime_type = None
+        self.warc_record = None
+        hrefs = []
+        base = self.url
+        validators = None
+        # A page that was not modified has no body to store in a WARC
+        # file, so with self.warc it is downloaded in full (and the cache
+        # updated as usual)
+        cached = self.cache.get(self.url) if self.cache is not None and not self.warc else None
+        if probe and cached is None:
+            self.mime_type = self.probe()
+            if self.mime_type is not None and self.mime_type != "text/html":
+                logging.debug("Skipping %s (HEAD says mimetype %s)" % (self.url, self.mime_type))
+                self.head_only = True
+                return
+        try:
+            url, parts, connection, response = self._open(cached.conditional_headers() if cached else None)
+            logging.debug("Succesfully connected to host")
+            if response.status == 304 and cached is not None:
+                response.read()
+                self._release(parts, connection, response)
+                logging.debug("Page %s not modified, using links from cache" % self.url)
+                self.not_modified = True
+                self.out_urls = dict.fromkeys(cached.links)
+                return
+            mime_type = self.mime_type = response.msg.get_content_type()
+            logging.debug("Mimetype is %s" % mime_type)
+
+            if mime_type != "text/html":
+                connection.close()
+                raise OpaqueDataException("Not interested in files of type %s" % mime_type, mime_type, url)
+            logging.debug("Fetching and parsing page")
             try:
-                data = handle.open(request, timeout=self.fetch_timeout_seconds)
-                logging.debug("Succesfully connected to host")
-                mime_type = data.info().get_content_type()
-                logging.debug("Mimetype is %s" % mime_type)
-                url = data.geturl()
-
-                if mime_type != "text/html":
-                    raise OpaqueDataException("Not interested in files of type %s" % mime_type, mime_type, url)
-                logging.debug("Fetching page from host")
-                content = data.read().decode("utf-8", errors="replace")
-                logging.debug("Parsing page")
-                soup = BeautifulSoup(content, "html.parser")
-                logging.debug("Page has been parsed")
-                tags = soup('a')
-            except urllib.error.HTTPError as error:
-                if error.code == 404:
-                    logging.debug("Error 404 while fetching %s" % error.url)
-                else:
-                    logging.debug("Error %s while fetching" % error)
-                self.fetch_failed = True
-                tags = []
-            except urllib.error.URLError as error:
+                extractor, complete, content_hash, body = self._read(response)
+            except (http.client.HTTPException, OSError, ValueError, zlib.error) as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            if complete:
+                self._release(parts, connection, response)
+            else:
+                connection.close()
+            logging.debug("Page has been parsed")
+            if body is not None:
+                self.warc_record = response_record(url, response.status, response.reason, response.getheaders(),
+                                                   body, not complete)
+            hrefs = extractor.hrefs
+            if extractor.base is not None:
+                base = urllib.parse.urljoin(self.url, extractor.base)
+            etag = response.getheader("ETag")
+            last_modified = response.getheader("Last-Modified")
+            if self.cache is not None and complete and (etag or last_modified):
+                validators = (etag, last_modified, content_hash)
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                logging.debug("Error 404 while fetching %s" % error.url)
+            else:
                 logging.debug("Error %s while fetching" % error)
-                self.fetch_failed = True
-                tags = []
-            except OpaqueDataException as error:
-                logging.debug("Skipping %s (has mimetype %s)" % (error.url, error.mimetype))
-                tags = []
+            self.fetch_failed = True
+            self.retryable = error.code >= 500 or error.code == 429
+        except urllib.error.URLError as error:
+            logging.debug("Error %s while fetching" % error)
+            self.fetch_failed = True
+            # A connection problem, unless the URL itself is at fault
+            self.retryable = not isinstance(error.reason, str)
+        except OpaqueDataException as error:
+            logging.debug("Skipping %s (has mimetype %s)" % (error.url, error.mimetype))
 
-            for tag in tags:
-                href = tag.get("href")
-                if href is not None:
-                    url = urllib.parse.urljoin(self.url, escape(href))
-                    if url not in self:
-                        self.out_urls.append(url)
+        self.add_out_links(base, hrefs)
+        if validators is not None:
+            self.cache.put(self.url, *validators, self.out_links())
 
 
 def parse_options():
@@ -332,6 +1512,123 @@ def parse_options():
     parser.add_option("-u", "--show-urls", action="store_true", default=False,
                       dest="out_urls", help="Output URLs found")
     
+    parser.add_option("-o", "--output",
+            action="store", type="string", dest="output",
+            help="Write the output of -u or -l to this file (- for standard output) as NDJSON, "
+                 "while crawling; with -p, every process writes to its own file, named with its number appended")
+
+    parser.add_option("--canonical",
+            action="store", type="string", default=",".join(DEFAULT_CANONICAL_RULES), dest="canonical",
+            help="Comma-separated rules for rewriting URLs to a canonical form: %s, or none to only strip "
+                 "fragments (default is %s)" % (", ".join(CANONICAL_RULES), ",".join(DEFAULT_CANONICAL_RULES)))
+
+    parser.add_option("--strip-param", action="append", type="string",
+            dest="strip_params", default=[],
+            help="Also strip this query parameter with the strip-params rule; a trailing * matches any "
+                 "ending (stripped by default: %s)" % ", ".join(STRIP_PARAMS))
+
+    parser.add_option("--warc",
+            action="store", type="string", dest="warc",
+            help="Store the pages fetched in this (compressed) WARC file, for selite.py to index; with -p, every "
+                 "process writes to its own file, named with its number inserted before the extension. With --cache, "
+                 "pages are then downloaded in full instead of revalidated, so the file has all of them")
+
+    parser.add_option("-b", "--max-body",
+            action="store", type="int", default=MAX_BODY_SIZE, dest="max_body_size",
+            help="Maximum number of bytes read from a page (default is %d)" % MAX_BODY_SIZE)
+
+    parser.add_option("-s", "--state",
+            action="store", type="string", dest="state",
+            help="Keep the crawl state in this SQLite file instead of in memory")
+
+    parser.add_option("-r", "--resume", action="store_true", default=False,
+            dest="resume", help="Resume the crawl saved in the --state file")
+
+    parser.add_option("--checkpoint",
+            action="store", type="int", default=CHECKPOINT_SECONDS, dest="checkpoint",
+            help="Seconds between saves of the crawl state (default is %d)" % CHECKPOINT_SECONDS)
+
+    parser.add_option("--seen",
+            action="store", type="choice", choices=SEEN_SET_KINDS, default="set", dest="seen",
+            help="How to store the URLs seen in memory: %s (default is set)" % ", ".join(SEEN_SET_KINDS))
+
+    parser.add_option("--bloom-error",
+            action="store", type="float", default=0.001, dest="bloom_error",
+            help="False positive rate of the Bloom filter used with --seen=bloom (default is 0.001)")
+
+    parser.add_option("--delay",
+            action="store", type="float", default=0, dest="delay",
+            help="Minimum seconds between requests to the same host (default is 0)")
+
+    parser.add_option("--ignore-robots", action="store_false", default=True,
+            dest="robots", help="Do not obey robots.txt")
+
+    parser.add_option("--no-compression", action="store_false", default=True,
+            dest="compress", help="Do not ask servers for compressed pages")
+
+    parser.add_option("--no-type-prediction", action="store_false", default=True,
+            dest="predict_types", help="Also request URLs that look like images, PDFs, archives and other "
+                                       "files that are not HTML")
+
+    parser.add_option("--head-probe", action="store_true", default=False,
+            dest="head_probe", help="Send a HEAD request first for URLs of which the content type can't "
+                                    "be guessed, and skip them if they are not HTML")
+
+    parser.add_option("--retries",
+            action="store", type="int", default=2, dest="retries",
+            help="Times to retry a fetch that timed out or got a server error (default is 2)")
+
+    parser.add_option("--retry-budget",
+            action="store", type="float", default=0.1, dest="retry_budget",
+            help="Retries allowed as a fraction of the pages followed (default is 0.1)")
+
+    parser.add_option("--host-failures",
+            action="store", type="int", default=5, dest="host_failures",
+            help="Failures in a row after which a host is left alone for a while, and skipped if that "
+                 "keeps happening; 0 never does this (default is 5)")
+
+    parser.add_option("--host-cooldown",
+            action="store", type="float", default=30, dest="host_cooldown",
+            help="Seconds a failing host is left alone at first, doubled every next time (default is 30)")
+
+    parser.add_option("--dns-ttl",
+            action="store", type="float", default=300, dest="dns_ttl",
+            help="Seconds to keep the address of a host (default is 300)")
+
+    parser.add_option("--cache",
+            action="store", type="string", dest="cache",
+            help="Revalidate pages against this SQLite cache of an earlier crawl, and update it")
+
+    parser.add_option("--cache-size",
+            action="store", type="int", default=100, dest="cache_size",
+            help="Maximum size of the cache in MB (default is 100)")
+
+    parser.add_option("-m", "--metrics",
+            action="store", type="string", dest="metrics",
+            help="Write timing histograms per fetch stage and per host as JSON to this file, "
+                 "during the crawl and at the end")
+
+    parser.add_option("--order",
+            action="store", type="choice", choices=CRAWL_ORDERS, default="bfs", dest="order",
+            help="Order in which to visit URLs: %s (default is bfs, breadth-first); "
+                 "a resumed crawl needs the same order" % ", ".join(CRAWL_ORDERS))
+
+    parser.add_option("--max-pages",
+            action="store", type="int", dest="max_pages",
+            help="Stop after fetching this many pages")
+
+    parser.add_option("-p", "--processes",
+            action="store", type="int", default=1, dest="processes",
+            help="Number of processes to crawl with, each owning a share of the hosts (default is 1)")
+
+    parser.add_option("-w", "--workers",
+            action="store", type="int", default=1, dest="workers",
+            help="Number of pages to fetch concurrently (default is 1)")
+
+    parser.add_option("--host-workers",
+            action="store", type="int", default=2, dest="host_workers",
+            help="Maximum number of concurrent fetches per host (default is 2)")
+
     opts, args = parser.parse_args()
 
     if len(args) < 1:
@@ -342,12 +1639,34 @@ def parse_options():
         parser.print_help(sys.stderr)
         parser.error("options -l and -u are mutually exclusive")
 
+    if opts.output and not (opts.out_urls or opts.out_links):
+        parser.error("option -o needs -u or -l")
+
+    if opts.output == "-" and opts.processes > 1:
+        parser.error("option -p can't write to standard output with -o, give a file name")
+
+    opts.canonical = [] if opts.canonical == "none" else [rule.strip() for rule in opts.canonical.split(",") if rule.strip()]
+    unknown = set(opts.canonical) - set(CANONICAL_RULES)
+    if unknown:
+        parser.error("unknown --canonical rules: %s" % ", ".join(sorted(unknown)))
+
+    if opts.head_probe and not opts.predict_types:
+        parser.error("options --head-probe and --no-type-prediction are mutually exclusive")
+
+    if opts.resume and not opts.state:
+        parser.error("option -r needs a state file given with -s")
+
+    if opts.state and opts.seen != "set":
+        parser.error("option --seen only applies to a crawl state in memory, not with -s")
+
+    if opts.state and opts.processes > 1:
+        parser.error("options -s and -p are mutually exclusive")
+
     return opts, args
     
 
 def main():
-    logformat = "%(levelname)s: %(asctime)s: %(message)s"
-    logging.basicConfig(filename='./crawler.log', level = logging.INFO, format = logformat)
+    logging.basicConfig(filename='./crawler.log', level = logging.INFO, format = LOGFORMAT)
     
     opts, args = parse_options()
 
@@ -362,21 +1681,103 @@ def main():
 
     logging.info("Recursive crawling started with maximum traversing depth set to %d" % depth_limit)
     logging.info("Maximum wait time per fetched page set to %d seconds" % fetch_timeout)
+    logging.info("Fetching with %d workers, at most %d per host" % (opts.workers, opts.host_workers))
     
-    crawler = Crawler(url, depth_limit, fetch_timeout, confine_prefix, exclude, locked=(not opts.unlocked))        
-    crawler.crawl()
+    state = DiskState(opts.state, opts.resume) if opts.state else None
+    cache_args = (opts.cache, opts.cache_size * 1024 * 1024) if opts.cache else None
+    if cache_args and opts.warc:
+        logging.info("Writing a WARC file, so pages are downloaded in full, not revalidated against the cache")
+    cache = None
+    output = None
+    output_args = (opts.output, opts.out_urls, opts.out_links) if opts.output else None
+    warc = None
+
+    args = (depth_limit, fetch_timeout, confine_prefix, exclude)
+    kwargs = dict(locked=(not opts.unlocked), workers=opts.workers, host_workers=opts.host_workers,
+                  max_body_size=opts.max_body_size, seen=opts.seen, seen_error_rate=opts.bloom_error,
+                  delay=opts.delay, robots=opts.robots, order=opts.order, max_pages=opts.max_pages, compress=opts.compress,
+                  canonical_rules=opts.canonical, strip_params=STRIP_PARAMS + tuple(opts.strip_params),
+                  retries=opts.retries, retry_budget=opts.retry_budget, host_failures=opts.host_failures,
+                  host_cooldown=opts.host_cooldown, dns_ttl=opts.dns_ttl, predict_types=opts.predict_types,
+                  head_probe=opts.head_probe)
+    try:
+        if opts.processes > 1:
+            logging.info("Crawling with %d processes" % opts.processes)
+            crawler = crawl_sharded(opts.processes, url, *args, cache_args=cache_args, metrics_path=opts.metrics,
+                                    output_args=output_args, warc_path=opts.warc, **kwargs)
+        else:
+            cache = ResponseCache(*cache_args) if cache_args else None
+            if output_args:
+                output = NdjsonWriter(*output_args, append=state is not None and state.resumed)
+            if opts.warc:
+                warc = WarcWriter(opts.warc, append=state is not None and state.resumed, software=AGENT)
+            crawler = Crawler(url, *args, state=state, cache=cache, output=output, warc=warc, **kwargs)
+            crawler.print_hosts = opts.output != "-"
+            crawler.checkpoint_seconds = opts.checkpoint
+            crawler.metrics_path = opts.metrics
+            crawler.crawl()
+    except KeyboardInterrupt:
+        if state is None:
+            raise
+        logging.warning("Crawl interrupted, resume it with -r -s %s" % opts.state)
+        print("Crawl interrupted, resume it with -r -s %s" % opts.state, file=sys.stderr)
+        raise SystemExit(1)
+    finally:
+        Fetcher.pool.close()
+        if output is not None:
+            output.close()
+        if warc is not None:
+            warc.close()
                           
-    if opts.out_urls:
+    if opts.out_urls and not opts.output:
         print("\n".join(crawler.urls_remembered))
 
-    if opts.out_links:
+    if opts.out_links and not opts.output:
         print("\n".join([str(l) for l in crawler.links_remembered]))
 
     eTime = time.time()
     tTime = eTime - sTime
 
     logging.info("Crawling completed with %d links found, %d followed en %d failed fetches" % (crawler.num_links, crawler.num_followed, crawler.num_failed_links))
+    if opts.robots:
+        logging.info("%d links not followed because of robots.txt" % crawler.num_robots_excluded)
+    if cache is not None:
+        logging.info("%d pages not modified since they were cached (%d cache hits, %d misses, %d evicted)" % (
+                     crawler.num_not_modified, cache.num_hits, cache.num_misses, cache.num_evicted))
+        cache.close()
+    elif cache_args:
+        logging.info("%d pages not modified since they were cached" % crawler.num_not_modified)
+    if crawler.num_bytes_decoded:
+        logging.info("Received %0.1f MB for %0.1f MB of pages, %0.1f MB (%d%%) saved by compression" % (
+                     crawler.num_bytes_received / 1e6, crawler.num_bytes_decoded / 1e6,
+                     (crawler.num_bytes_decoded - crawler.num_bytes_received) / 1e6,
+                     100 * (crawler.num_bytes_decoded - crawler.num_bytes_received) / crawler.num_bytes_decoded))
+    if crawler.num_retries or crawler.num_host_skipped:
+        logging.info("%d fetches retried, %d links skipped because their host seemed to be down" % (
+                     crawler.num_retries, crawler.num_host_skipped))
+    if opts.processes == 1 and crawler.breaker is not None and crawler.breaker.failures:
+        logging.info("Hosts with the most failures: %s" % ", ".join("%s %d" % f for f in crawler.breaker.worst()))
+    if warc is not None:
+        logging.info("%d pages stored in %s" % (warc.num_records - 1, opts.warc))
+    if opts.predict_types:
+        logging.info("%d requests avoided for links that did not seem to be HTML" % crawler.num_type_skipped)
+    if opts.head_probe:
+        logging.info("%d downloads avoided by a HEAD request" % crawler.num_head_skipped)
+    if opts.canonical:
+        logging.info("%d fetches saved by rewriting URLs to a canonical form" % crawler.num_fetches_saved)
+    if opts.processes == 1:
+        logging.info("Looked up %d hosts ahead of time; %d lookups came from the DNS cache, %d did not" % (
+                     crawler.resolver.num_prefetched, crawler.resolver.num_hits, crawler.resolver.num_misses))
+        logging.info("Opened %d connections for %d followed links (%d requests reused a connection)" % (Fetcher.pool.num_created, crawler.num_followed, Fetcher.pool.num_reused))
+        logging.info("At most %d URLs waited for their host at once" % crawler.max_scheduled)
     logging.info("Found %d links per second in %0.2f seconds" % (int(math.ceil(float(crawler.num_links) / tTime)), tTime))
 
+    if state is not None:
+        state.close()
+    elif opts.processes == 1:
+        logging.info("Sets of URLs seen and visited (%s) use %0.1f MB for %d URLs" % (opts.seen,
+                     (memory_bytes(crawler.urls_seen) + memory_bytes(crawler.visited_links) +
+                      memory_bytes(crawler.spellings_seen)) / 1e6, len(crawler.urls_seen)))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+  The inverted index of selite.py, in memory (InvertedIndex) and on disk
+  (DiskIndex), so a search can be answered without crawling and indexing
+  again. On disk, an index is a directory of files:
+
+      index.json          format version and sizes
+      terms.bin/.npy      the terms in sorted order, as UTF-8 strings one
+                          after the other, and where each one starts
+      postings.npy        where the postings of each term start
+      doc_ids.npy         document numbers of all postings (int32)
+      weights.npy         weights of all postings (float32)
+      impact_order.npy    the postings of each term by impact (int32)
+      urls.bin/.npy       the URL of each document, like the terms
+      ranks.npy           the PageRank of each document (float64)
+
+  Opening an index only reads index.json; the other files are memory
+  mapped, and a term is found by binary search in the term dictionary,
+  so opening takes about as long for a large index as for a small one.
+"""
+
+import os
+import json
+import bisect
+import shutil
+import tempfile
+
+import numpy as np
+
+FORMAT = 2
+
+
+class StringTable(object):
+
+    """A sequence of strings stored as one block of UTF-8 (blob) and the
+    offsets where each string starts, both memory mapped"""
+
+    def __init__(self, path):
+        self.offsets = np.load(path + ".npy", mmap_mode="r")
+        self.blob = np.memmap(path + ".bin", dtype=np.uint8, mode="r") if self.offsets[-1] else b""
+
+    @staticmethod
+    def write(path, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        with open(path + ".bin", "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(path + ".npy", offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def write_index(path, index):
+    """Write an InvertedIndex to the directory path (created if needed)
+
+    The files are written to a new directory next to path, which then
+    replaces path, so the index at path is complete whenever it can be
+    opened, also while an earlier index there is still being read. An
+    existing path must be an index or empty."""
+    path = os.path.abspath(path)
+    if os.path.exists(path) and os.listdir(path) and \
+            not os.path.exists(os.path.join(path, "index.json")):
+        raise ValueError("%s: not an index, won't replace it" % path)
+    parent, name = os.path.split(path)
+    os.makedirs(parent, exist_ok=True)
+    new = tempfile.mkdtemp(prefix="." + name + ".", dir=parent)
+    try:
+        # mkdtemp makes the directory private; give it the permissions
+        # os.makedirs would, so others can still read the index
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(new, 0o777 & ~umask)
+        StringTable.write(os.path.join(new, "terms"), index.terms)
+        np.save(os.path.join(new, "postings.npy"), np.asarray(index.offsets, dtype=np.int64))
+        np.save(os.path.join(new, "doc_ids.npy"), np.asarray(index.doc_ids, dtype=np.int32))
+        np.save(os.path.join(new, "weights.npy"), np.asarray(index.weights, dtype=np.float32))
+        np.save(os.path.join(new, "impact_order.npy"), np.asarray(index.impact_order, dtype=np.int32))
+        StringTable.write(os.path.join(new, "urls"), index.urls)
+        np.save(os.path.join(new, "ranks.npy"), np.asarray(index.ranks, dtype=np.float64))
+        with open(os.path.join(new, "index.json"), "w") as f:
+            json.dump({"format": FORMAT, "documents": len(index.urls), "terms": len(index.terms),
+                       "postings": int(index.offsets[-1])}, f)
+    except BaseException:
+        shutil.rmtree(new, ignore_errors=True)
+        raise
+    if not os.path.exists(path):
+        os.rename(new, path)
+        return
+    # A directory can't replace another one in a single rename, so the old
+    # one is moved aside first; files of it that are open stay readable
+    old = tempfile.mkdtemp(prefix="." + name + ".old.", dir=parent)
+    os.rename(path, os.path.join(old, name))
+    os.rename(new, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class InvertedIndex(object):
+
+    """Postings of documents numbered 0 to len(urls) - 1, by term: the
+    postings of terms[i] are doc_ids[offsets[i]:offsets[i + 1]], with the
+    same slice of weights, ordered by document number. terms is sorted,
+    ranks holds the PageRank of each document.
+
+    impact_order[offsets[i]:offsets[i + 1]] puts the postings of terms[i]
+    in order of impact, weight times PageRank, highest first: the numbers
+    are positions in the postings of the term.
+
+    For selite.py, it also looks like the index dict it used to build:
+    index[term] is a list of (url, weight) and rank a dict of PageRank by
+    URL."""
+
+    def __init__(self, terms, offsets, doc_ids, weights, impact_order, urls, ranks):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.impact_order = impact_order
+        self.urls = urls
+        self.ranks = ranks
+        self._rank = None
+
+    @property
+    def num_docs(self):
+        return len(self.urls)
+
+    def term_id(self, term):
+        """Number of term in the term dictionary, or None"""
+        i = bisect.bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def postings(self, term):
+        """postings(term) -> document numbers, weights
+
+        Both are arrays, empty if term is not in the index"""
+        i = self.term_id(term)
+        if i is None:
+            return self.doc_ids[:0], self.weights[:0]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.doc_ids[start:end], self.weights[start:end]
+
+    def impact_postings(self, term):
+        """impact_postings(term) -> document numbers, weights, impact order
+
+        Like postings(), with the positions of the postings in order of
+        impact. Nothing is read until the arrays are used, so reading the
+        postings with the highest impact first is fast for any term."""
+        i = self.term_id(term)
+        if i is None:
+            return self.doc_ids[:0], self.weights[:0], self.impact_order[:0]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.doc_ids[start:end], self.weights[start:end], self.impact_order[start:end]
+
+    def document_frequency(self, term):
+        i = self.term_id(term)
+        return 0 if i is None else int(self.offsets[i + 1] - self.offsets[i])
+
+    def __contains__(self, term):
+        return self.term_id(term) is not None
+
+    def __getitem__(self, term):
+        doc_ids, weights = self.postings(term)
+        return [(self.urls[d], w) for d, w in zip(doc_ids.tolist(), weights.tolist())]
+
+    def __len__(self):
+        return len(self.terms)
+
+    @property
+    def rank(self):
+        """PageRank by URL, as a dict"""
+        if self._rank is None:
+            self._rank = dict(zip(self.urls, self.ranks.tolist()))
+        return self._rank
+
+
+class DiskIndex(InvertedIndex):
+
+    """An index written by write_index(), opened read-only"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT:
+            raise ValueError("%s: unsupported index format %s" % (path, meta.get("format")))
+        InvertedIndex.__init__(self, StringTable(os.path.join(path, "terms")),
+                               np.load(os.path.join(path, "postings.npy"), mmap_mode="r"),
+                               self._load("doc_ids.npy"), self._load("weights.npy"),
+                               self._load("impact_order.npy"),
+                               StringTable(os.path.join(path, "urls")), self._load("ranks.npy"))
+
+    def _load(self, name):
+        # An empty array can't be memory mapped
+        array = np.load(os.path.join(self.path, name), mmap_mode="r")
+        return array if array.size else np.load(os.path.join(self.path, name))
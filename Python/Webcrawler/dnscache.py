@@ -0,0 +1,129 @@
+"""
+  A cache of host name lookups for crawler.py. A crawl makes many
+  connections to a handful of hosts; with the cache, the system resolver
+  is asked about each host only once per ttl seconds instead of for every
+  connection. Hosts can be resolved ahead of time (prefetch), as soon as
+  the crawler finds the first link to them, so that a page fetch hardly
+  ever has to wait for a lookup.
+
+  getaddrinfo() does not tell the TTL of a DNS record, so every answer is
+  kept for the same fixed time. Failed lookups are kept for a shorter
+  time, so a dead host does not cost a lookup per URL either.
+"""
+
+import time
+import socket
+import logging
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class DnsCache(object):
+
+    """Results of socket.getaddrinfo() per (host, port), kept for ttl
+    seconds (negative_ttl for failures), shared by all threads. A lookup
+    that is already running, for instance a prefetch, is waited for
+    instead of being started again."""
+
+    def __init__(self, ttl=300, negative_ttl=30, max_size=100000, prefetch_workers=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.prefetch_workers = prefetch_workers
+        self._entries = {}                          # (host, port) -> [Future, time it expires]
+        self._lock = threading.Lock()
+        self._executor = None                       # Threads for prefetching, started when first needed
+
+        self.num_hits = 0                           # Lookups answered from the cache (or a running lookup)
+        self.num_misses = 0                         # Lookups that had to ask the system resolver
+        self.num_prefetched = 0                     # Lookups started ahead of time
+
+    def _claim(self, key, now):
+        """Returns (future, True) if the caller has to resolve key itself,
+        or (future, False) if it is cached or being resolved already."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0], False
+        if len(self._entries) >= self.max_size:
+            self._evict(now)
+        future = Future()
+        self._entries[key] = [future, float("inf")]
+        return future, True
+
+    def _evict(self, now):
+        """Remove expired entries, and the oldest ones if that's not enough"""
+        for key in [key for key, (future, expires) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_size:
+            del self._entries[next(iter(self._entries))]
+
+    def _lookup(self, key, future):
+        host, port = key
+        try:
+            result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except OSError as e:
+            future.set_exception(e)
+            ttl = self.negative_ttl
+        else:
+            future.set_result(result)
+            ttl = self.ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is future:
+                entry[1] = time.monotonic() + ttl
+
+    def resolve(self, host, port):
+        """Like socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM),
+        raising socket.gaierror (or another OSError) if the lookup fails"""
+        key = (host.lower(), port)
+        with self._lock:
+            future, claimed = self._claim(key, time.monotonic())
+            if claimed:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+        if claimed:
+            self._lookup(key, future)
+        return future.result()
+
+    def prefetch(self, host, port):
+        """Start looking up host in the background, unless it is cached"""
+        key = (host.lower(), port)
+        with self._lock:
+            future, claimed = self._claim(key, time.monotonic())
+            if not claimed:
+                return
+            self.num_prefetched += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix="dns")
+            self._executor.submit(self._lookup, key, future)
+        logging.debug("Prefetching address of %s" % host)
+
+    def prefetch_url(self, url):
+        """prefetch() for the host of url"""
+        try:
+            parts = urlsplit(url)
+            port = parts.port or DEFAULT_PORTS.get(parts.scheme)
+        except ValueError:
+            return
+        if parts.hostname and port:
+            self.prefetch(parts.hostname, port)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Stop prefetching. Prefetches that had not started yet are
+        dropped from the cache."""
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+        with self._lock:
+            for key, (future, expires) in list(self._entries.items()):
+                if not future.done():
+                    future.set_exception(OSError("lookup of %s was cancelled" % key[0]))
+                    del self._entries[key]
@@ -0,0 +1,464 @@
+"""
+  Storage for the state of a crawl done by crawler.py: the queue of URLs
+  that still have to be visited, and the sets of URLs and links that have
+  been seen, visited and remembered.
+
+  By default everything is kept in memory. A DiskState keeps the same
+  data in an SQLite database instead, so that memory use does not grow
+  with the size of the crawl, and so that an interrupted crawl can be
+  resumed from the last checkpoint.
+
+  For very large crawls in memory, the sets of URLs seen and visited can
+  be replaced by a FingerprintSet or a BloomFilter, which store a few
+  bytes per URL instead of the URL itself.
+
+  Instead of first-in, first-out, the queue can hand out the URL with the
+  highest priority first (a PriorityQueue, or a DiskPriorityQueue with a
+  DiskState). The crawler raises the priority of a queued URL every time
+  it finds another link to it, see CRAWL_ORDERS.
+"""
+
+import sys
+import math
+import sqlite3
+import heapq
+import hashlib
+from array import array
+from collections import deque
+
+SEEN_SET_KINDS = ("set", "fingerprint", "bloom")
+
+CRAWL_ORDERS = ("bfs",                              # Breadth-first, in the order URLs were found
+                "opic",                             # Highest OPIC cash first (a page shares its cash over its links)
+                "inlinks")                          # Most links found to the URL so far first
+
+
+class FifoQueue(object):
+
+    """In-memory first-in, first-out queue of (url, depth) pairs"""
+
+    def __init__(self):
+        self._items = deque()
+
+    def put(self, url, depth, priority=0.0):
+        """Add url to the end of the queue; priority is ignored"""
+        self._items.append((url, depth))
+
+    def get(self):
+        return self._items.popleft()
+
+    def done(self, url):
+        """Called once a URL taken with get() has been dealt with"""
+        pass
+
+    def empty(self):
+        return not self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return (url for url, depth in self._items)
+
+
+class PriorityQueue(object):
+
+    """In-memory queue of (url, depth) pairs that hands out the URL with
+    the highest priority first, and the oldest of those on a tie.
+
+    The priority of a queued URL can be raised with credit(). Instead of
+    moving the URL in the heap, a new heap entry is pushed and the old one
+    is skipped when it comes up."""
+
+    def __init__(self):
+        self._heap = []                             # (-priority, sequence number, url), some of them stale
+        self._entries = {}                          # url -> [priority, depth, sequence number] of queued URLs
+        self._taken = {}                            # url -> priority of URLs handed out, but not done
+        self._count = 0
+
+    def put(self, url, depth, priority=0.0):
+        if url in self._entries:
+            self.credit(url, priority, depth)
+            return
+        self._count += 1
+        self._entries[url] = [priority, depth, self._count]
+        heapq.heappush(self._heap, (-priority, self._count, url))
+
+    def credit(self, url, amount, depth=None):
+        """Raise the priority of url by amount, and lower its depth to
+        depth, if it is waiting in the queue"""
+        entry = self._entries.get(url)
+        if entry is None:
+            return
+        entry[0] += amount
+        if depth is not None and depth < entry[1]:
+            entry[1] = depth
+        heapq.heappush(self._heap, (-entry[0], entry[2], url))
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._compact()
+
+    def _compact(self):
+        """Drop the stale heap entries"""
+        self._heap = [(-priority, n, url) for url, (priority, depth, n) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def get(self):
+        while self._heap:
+            priority, n, url = heapq.heappop(self._heap)
+            entry = self._entries.get(url)
+            if entry is None or entry[0] != -priority or entry[2] != n:
+                continue
+            del self._entries[url]
+            self._taken[url] = entry[0]
+            return url, entry[1]
+        raise IndexError("get from an empty queue")
+
+    def score(self, url):
+        """The priority of url, if it is queued or handed out but not done"""
+        entry = self._entries.get(url)
+        if entry is not None:
+            return entry[0]
+        return self._taken.get(url, 0.0)
+
+    def done(self, url):
+        self._taken.pop(url, None)
+
+    def empty(self):
+        return not self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+
+class DiskState(object):
+
+    """An SQLite database holding the state of a crawl.
+
+    Changes are only committed by checkpoint(). After a crash or an
+    interrupt, a crawl started with resume=True continues from the last
+    checkpoint; otherwise any earlier state in the database is removed."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+        self.resumed = resume and self.db.execute("SELECT COUNT(*) FROM counters").fetchone()[0] > 0
+        if not self.resumed:
+            tables = [row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            for table in tables:
+                self.db.execute("DELETE FROM %s" % table)
+            self.db.commit()
+
+    def queue(self, name="queue"):
+        return DiskQueue(self.db, name)
+
+    def priority_queue(self, name="priority_queue"):
+        return DiskPriorityQueue(self.db, name)
+
+    def set(self, name, columns=("value",), encode=None, decode=None):
+        return DiskSet(self.db, name, columns, encode, decode)
+
+    def load_counters(self):
+        """Returns the counters saved by the last checkpoint as a dict"""
+        return dict(self.db.execute("SELECT name, value FROM counters"))
+
+    def checkpoint(self, counters):
+        """Save counters (a dict of name -> int) and commit all changes"""
+        self.db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", counters.items())
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class DiskQueue(object):
+
+    """First-in, first-out queue of (url, depth) pairs in an SQLite table.
+
+    A row is only deleted when done() is called for its URL, so URLs that
+    were being fetched when the crawl stopped are still in the queue when
+    it is resumed."""
+
+    BATCH = 256                                     # Rows read from the database at a time
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        db.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, depth INTEGER)" % name)
+        self._size = db.execute("SELECT COUNT(*) FROM %s" % name).fetchone()[0]
+        self._last_id = 0                           # Highest row id read so far
+        self._buffer = deque()                      # Rows read, but not handed out yet
+        self._pending = {}                          # URL -> row ids handed out, but not done
+
+    def put(self, url, depth, priority=0.0):
+        """Add url to the end of the queue; priority is ignored"""
+        self.db.execute("INSERT INTO %s (url, depth) VALUES (?, ?)" % self.name, (url, depth))
+        self._size += 1
+
+    def get(self):
+        if not self._buffer:
+            rows = self.db.execute("SELECT id, url, depth FROM %s WHERE id > ? ORDER BY id LIMIT ?" % self.name,
+                                   (self._last_id, self.BATCH)).fetchall()
+            if not rows:
+                raise IndexError("get from an empty queue")
+            self._last_id = rows[-1][0]
+            self._buffer.extend(rows)
+        row_id, url, depth = self._buffer.popleft()
+        self._pending.setdefault(url, []).append(row_id)
+        self._size -= 1
+        return url, depth
+
+    def done(self, url):
+        ids = self._pending.get(url)
+        if ids:
+            self.db.execute("DELETE FROM %s WHERE id = ?" % self.name, (ids.pop(0),))
+            if not ids:
+                del self._pending[url]
+
+    def empty(self):
+        return self._size == 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """All URLs in the table, including the ones not done yet"""
+        return (row[0] for row in self.db.execute("SELECT url FROM %s ORDER BY id" % self.name).fetchall())
+
+
+class DiskPriorityQueue(object):
+
+    """Queue of (url, depth) pairs in an SQLite table that hands out the URL
+    with the highest priority first, like PriorityQueue.
+
+    Rows handed out are marked as taken and only deleted when done() is
+    called, so a resumed crawl hands them out again."""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        db.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT UNIQUE, "
+                   "depth INTEGER, priority REAL, taken INTEGER DEFAULT 0)" % name)
+        db.execute("CREATE INDEX IF NOT EXISTS %s_next ON %s (taken, priority DESC, id)" % (name, name))
+        db.execute("UPDATE %s SET taken = 0 WHERE taken = 1" % name)
+        self._size = db.execute("SELECT COUNT(*) FROM %s" % name).fetchone()[0]
+
+    def put(self, url, depth, priority=0.0):
+        cursor = self.db.execute("INSERT OR IGNORE INTO %s (url, depth, priority) VALUES (?, ?, ?)" % self.name,
+                                 (url, depth, priority))
+        if cursor.rowcount:
+            self._size += 1
+        else:
+            self.credit(url, priority, depth)
+
+    def credit(self, url, amount, depth=None):
+        """Raise the priority of url by amount, and lower its depth to
+        depth, if it is waiting in the queue"""
+        self.db.execute("UPDATE %s SET priority = priority + ?, depth = MIN(depth, COALESCE(?, depth)) "
+                        "WHERE url = ? AND taken = 0" % self.name, (amount, depth, url))
+
+    def get(self):
+        row = self.db.execute("SELECT id, url, depth FROM %s WHERE taken = 0 ORDER BY priority DESC, id LIMIT 1"
+                              % self.name).fetchone()
+        if row is None:
+            raise IndexError("get from an empty queue")
+        self.db.execute("UPDATE %s SET taken = 1 WHERE id = ?" % self.name, (row[0],))
+        self._size -= 1
+        return row[1], row[2]
+
+    def score(self, url):
+        """The priority of url, if it is in the queue"""
+        row = self.db.execute("SELECT priority FROM %s WHERE url = ?" % self.name, (url,)).fetchone()
+        return row[0] if row else 0.0
+
+    def done(self, url):
+        self.db.execute("DELETE FROM %s WHERE url = ? AND taken = 1" % self.name, (url,))
+
+    def empty(self):
+        return self._size == 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """All URLs in the table, including the ones not done yet"""
+        return (row[0] for row in self.db.execute("SELECT url FROM %s ORDER BY id" % self.name).fetchall())
+
+
+class DiskSet(object):
+
+    """A set stored in an SQLite table. Items are stored as a tuple of
+    columns; encode and decode convert between items and such tuples and
+    default to storing an item in a single column."""
+
+    def __init__(self, db, name, columns=("value",), encode=None, decode=None):
+        self.db = db
+        self.name = name
+        self.encode = encode or (lambda item: (item,))
+        self.decode = decode or (lambda row: row[0])
+        self.columns = ", ".join(columns)
+        self._where = " AND ".join("%s = ?" % c for c in columns)
+        self._values = ", ".join("?" for c in columns)
+        db.execute("CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s)) WITHOUT ROWID" % (name, self.columns, self.columns))
+
+    def add(self, item):
+        self.db.execute("INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (self.name, self.columns, self._values), self.encode(item))
+
+    def discard(self, item):
+        self.db.execute("DELETE FROM %s WHERE %s" % (self.name, self._where), self.encode(item))
+
+    def __contains__(self, item):
+        return self.db.execute("SELECT 1 FROM %s WHERE %s" % (self.name, self._where), self.encode(item)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM %s" % self.name).fetchone()[0]
+
+    def __iter__(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT %s FROM %s" % (self.columns, self.name))
+        return (self.decode(row) for row in cursor)
+
+
+def fingerprint(url):
+    """64-bit fingerprint of a URL"""
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+
+class FingerprintSet(object):
+
+    """Set of URLs that only stores a 64-bit fingerprint of each URL, in an
+    open-addressing hash table backed by an array. That is 8 bytes per slot
+    and at most 16 bytes per URL, against well over 100 bytes for a Python
+    set of strings. Two URLs with the same fingerprint are taken to be the
+    same; with 64 bits that is unlikely below billions of URLs."""
+
+    def __init__(self, capacity=1024):
+        size = 1024
+        while size < 2 * capacity:
+            size *= 2
+        self._slots = array("Q", bytes(8 * size))  # 0 marks an empty slot
+        self._mask = size - 1
+        self._len = 0
+
+    def _slot(self, fp):
+        """Index of the slot holding fp, or of the empty slot where it belongs"""
+        slots = self._slots
+        i = fp & self._mask
+        while slots[i] and slots[i] != fp:
+            i = (i + 1) & self._mask
+        return i
+
+    def add(self, url):
+        fp = fingerprint(url) or 1
+        i = self._slot(fp)
+        if not self._slots[i]:
+            self._slots[i] = fp
+            self._len += 1
+            if 2 * self._len > len(self._slots):
+                self._grow()
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array("Q", bytes(16 * len(old)))
+        self._mask = len(self._slots) - 1
+        for fp in old:
+            if fp:
+                self._slots[self._slot(fp)] = fp
+
+    def __contains__(self, url):
+        return bool(self._slots[self._slot(fingerprint(url) or 1)])
+
+    def __len__(self):
+        return self._len
+
+    def memory_bytes(self):
+        return sys.getsizeof(self._slots)
+
+
+class BloomFilter(object):
+
+    """Set of URLs as a Bloom filter: membership tests may wrongly say that
+    a URL was seen (with probability error_rate), but never the other way
+    round. For the crawler that means a small fraction of URLs is skipped.
+
+    The filter is sized for capacity URLs. When more are added, a new
+    filter twice as large and with a tighter error rate is started, so the
+    overall error rate stays below error_rate."""
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.error_rate = error_rate
+        self._filters = []                          # [(bits, number of bits, hashes, capacity, error rate)]
+        self._len = 0
+        self._count = 0                             # URLs added to the newest filter
+        self._add_filter(capacity, error_rate / 2)
+
+    def _add_filter(self, capacity, error_rate):
+        nbits = max(64, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        hashes = max(1, int(round(nbits / capacity * math.log(2))))
+        self._filters.append((bytearray((nbits + 7) // 8), nbits, hashes, capacity, error_rate))
+        self._count = 0
+
+    @staticmethod
+    def _hash(url):
+        digest = hashlib.blake2b(url.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def _found(self, h1, h2):
+        for bits, nbits, hashes, capacity, error_rate in self._filters:
+            for i in range(hashes):
+                p = (h1 + i * h2) % nbits
+                if not bits[p >> 3] & (1 << (p & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def add(self, url):
+        h1, h2 = self._hash(url)
+        if self._found(h1, h2):
+            return
+        if self._count >= self._filters[-1][3]:
+            capacity, error_rate = self._filters[-1][3:]
+            self._add_filter(2 * capacity, error_rate / 2)
+        bits, nbits, hashes = self._filters[-1][:3]
+        for i in range(hashes):
+            p = (h1 + i * h2) % nbits
+            bits[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+        self._len += 1
+
+    def __contains__(self, url):
+        return self._found(*self._hash(url))
+
+    def __len__(self):
+        """Number of URLs added (not counting ones wrongly taken as seen)"""
+        return self._len
+
+    def memory_bytes(self):
+        return sum(sys.getsizeof(bloom[0]) for bloom in self._filters)
+
+
+def seen_set(kind="set", capacity=1000000, error_rate=0.001):
+    """Create a set of URLs of the given kind (one of SEEN_SET_KINDS).
+    capacity and error_rate only size a Bloom filter; a FingerprintSet
+    grows as needed."""
+    if kind == "fingerprint":
+        return FingerprintSet()
+    if kind == "bloom":
+        return BloomFilter(capacity, error_rate)
+    return set()
+
+
+def memory_bytes(urls):
+    """Approximate memory used by a set of URLs"""
+    if hasattr(urls, "memory_bytes"):
+        return urls.memory_bytes()
+    if isinstance(urls, set):
+        return sys.getsizeof(urls) + sum(sys.getsizeof(url) for url in urls)
+    return 0
@@ -0,0 +1,118 @@
+"""
+  An on-disk cache of fetched pages for crawler.py, so that a site that is
+  crawled again can be revalidated instead of downloaded again.
+
+  For every page that came with an ETag or Last-Modified header, the cache
+  keeps those validators, the out-links found on the page and a hash of
+  its content. The Fetcher sends them back in a conditional request and,
+  when the server answers 304 Not Modified, takes the out-links from the
+  cache without reading or parsing the page.
+
+  The cache is an SQLite database that is kept below a size limit by
+  removing the least recently used pages.
+"""
+
+import time
+import sqlite3
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+
+def cache_key(url):
+    """Normalized form of url used as key: no fragment, and the scheme
+    and host in lower case"""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+
+
+class CacheEntry(object):
+
+    def __init__(self, url, etag, last_modified, content_hash, links):
+        self.url = url
+        self.etag = etag                            # ETag header, or None
+        self.last_modified = last_modified          # Last-Modified header, or None
+        self.content_hash = content_hash            # SHA-256 of the page body, in hex
+        self.links = links                          # Out-links of the page, in order
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+
+    """Cache of page validators and out-links, shared by the fetcher threads.
+
+    max_size is the limit in bytes on the stored data (URLs, headers and
+    links); the least recently used pages are removed to stay below it."""
+
+    def __init__(self, path, max_size=100 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                        "content_hash TEXT, links TEXT, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+        self.num_hits = 0                           # Pages found in the cache
+        self.num_misses = 0                         # Pages not found in the cache
+        self.num_evicted = 0                        # Pages removed to stay below max_size
+
+    def get(self, url):
+        """Returns the CacheEntry for url, or None"""
+        key = cache_key(url)
+        with self._lock:
+            row = self.db.execute("SELECT etag, last_modified, content_hash, links FROM pages WHERE url = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+            self.db.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), key))
+        etag, last_modified, content_hash, links = row
+        return CacheEntry(key, etag, last_modified, content_hash, links.split("\n") if links else [])
+
+    def put(self, url, etag, last_modified, content_hash, links):
+        """Store the validators and out-links of a page"""
+        key = cache_key(url)
+        links = "\n".join(links)
+        size = len(key) + len(etag or "") + len(last_modified or "") + len(content_hash) + len(links)
+        with self._lock:
+            old = self.db.execute("SELECT size FROM pages WHERE url = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO pages (url, etag, last_modified, content_hash, links, size, last_used) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, etag, last_modified, content_hash, links, size, time.time()))
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used pages until the cache is at 90% of max_size"""
+        target = self.max_size * 0.9
+        while self.size > target:
+            rows = self.db.execute("SELECT url, size FROM pages ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                break
+            removed = []
+            for url, size in rows:
+                removed.append((url,))
+                self.size -= size
+                if self.size <= target:
+                    break
+            self.db.executemany("DELETE FROM pages WHERE url = ?", removed)
+            self.num_evicted += len(removed)
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,117 @@
+"""
+  Timing metrics for crawler.py. Every fetch records how long it spent in
+  each stage (see STAGES); CrawlMetrics collects these timings into
+  histograms, over the whole crawl and per host, and writes them out as
+  JSON.
+"""
+
+import json
+import math
+import time
+from collections import defaultdict
+
+STAGES = ("dns",        # Resolving the host name
+          "connect",    # Setting up the TCP connection (and TLS)
+          "ttfb",       # From sending the request to receiving the response headers
+          "download",   # Reading the response body
+          "decode",     # Decoding the body to text
+          "extract",    # Finding and resolving links
+          "total")      # The whole fetch
+
+
+class Histogram(object):
+
+    """Histogram of durations in seconds, with buckets that double in size,
+    starting at 0.1 ms"""
+
+    FIRST = 0.0001                                  # Upper bound of the first bucket
+    BUCKETS = 24                                    # The last bucket holds everything above ~14 minutes
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        i = 0 if seconds <= self.FIRST else int(math.ceil(math.log2(seconds / self.FIRST)))
+        self.buckets[min(i, self.BUCKETS - 1)] += 1
+
+    def upper_bound(self, i):
+        return self.FIRST * 2 ** i
+
+    def percentile(self, p):
+        """Estimate of the p-th percentile: the upper bound of the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "buckets": {"%g" % self.upper_bound(i): n for i, n in enumerate(self.buckets) if n}}
+
+
+class FetchTimings(object):
+
+    """The time spent in each stage of a single fetch. Stages may be timed
+    more than once (after a redirect, or per chunk read); the times add up."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._start = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def finish(self):
+        self.seconds["total"] = time.perf_counter() - self._start
+
+
+class CrawlMetrics(object):
+
+    """Histograms per stage for all fetches of a crawl, and per host"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.hosts = defaultdict(lambda: {"pages": 0, "failed": 0, "stages": {stage: Histogram() for stage in STAGES}})
+
+    def record(self, host, timings, failed=False):
+        """Add the FetchTimings of a fetch from host"""
+        per_host = self.hosts[host]
+        per_host["pages"] += 1
+        per_host["failed"] += failed
+        for stage, seconds in timings.seconds.items():
+            self.stages[stage].add(seconds)
+            per_host["stages"][stage].add(seconds)
+
+    def to_dict(self):
+        return {"started": self.started,
+                "elapsed": time.time() - self.started,
+                "stages": {stage: h.to_dict() for stage, h in self.stages.items()},
+                "hosts": {host: {"pages": h["pages"],
+                                 "failed": h["failed"],
+                                 "stages": {stage: hist.to_dict() for stage, hist in h["stages"].items() if hist.count}}
+                          for host, h in self.hosts.items()}}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
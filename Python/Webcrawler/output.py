@@ -0,0 +1,53 @@
+"""
+  Streaming output for crawler.py. Instead of collecting every URL and
+  link found and printing them when the crawl is over, an NdjsonWriter
+  writes each one as a line of JSON (NDJSON) as soon as it is found, so
+  other tools can read the output while the crawl is still running.
+
+  A URL is written as {"url": ...} and a link as
+  {"src": ..., "dst": ..., "type": ...}.
+"""
+
+import sys
+import json
+
+BUFFER_SIZE = 64 * 1024                             # Bytes written to the file at a time
+
+
+class NdjsonWriter(object):
+
+    """Writes the URLs (if urls is True) and links (if links is True) found
+    by a crawl to path, or to standard output if path is "-". With append
+    True, an existing file is added to instead of replaced, as is done for
+    a resumed crawl."""
+
+    def __init__(self, path, urls=True, links=True, append=False):
+        self.path = path
+        self.urls = urls
+        self.links = links
+        if path == "-":
+            self._file = sys.stdout
+        else:
+            self._file = open(path, "a" if append else "w", encoding="utf-8", buffering=BUFFER_SIZE)
+        self._encode = json.JSONEncoder(ensure_ascii=False).encode
+        self.num_written = 0
+
+    def write_url(self, url):
+        if self.urls:
+            self._file.write('{"url": %s}\n' % self._encode(url))
+            self.num_written += 1
+
+    def write_link(self, src, dst, link_type):
+        if self.links:
+            self._file.write('{"src": %s, "dst": %s, "type": %s}\n' % (self._encode(src), self._encode(dst),
+                                                                        self._encode(link_type)))
+            self.num_written += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is sys.stdout:
+            self._file.flush()
+        else:
+            self._file.close()
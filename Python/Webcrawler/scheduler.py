@@ -0,0 +1,292 @@
+"""
+  Politeness for crawler.py: a scheduler that keeps a queue of URLs per
+  host and hands out the next URL that may be fetched, and a cache of the
+  robots.txt rules of every host.
+
+  The scheduler rotates over the hosts that have URLs waiting, so that a
+  slow host does not hold up the others. A host is only handed out while
+  it has fewer than host_workers fetches running and its delay since the
+  last request (set by --delay or by a Crawl-delay in robots.txt) has
+  passed.
+
+  A CircuitBreaker keeps track of hosts that keep failing, so that their
+  URLs can be put off for a while, or skipped once a host looks dead.
+"""
+
+import time
+import heapq
+import logging
+from collections import deque, defaultdict
+from urllib.robotparser import RobotFileParser
+
+
+class HostScheduler(object):
+
+    """Per-host queues of (url, depth) pairs. Each host with URLs waiting
+    is either ready (in the round-robin rotation), waiting for its delay to
+    pass (in a heap ordered by time), or parked because it is blocked or
+    has host_workers fetches running."""
+
+    def __init__(self, host_workers, delay=0):
+        self.host_workers = host_workers            # Maximum concurrent fetches per host
+        self.delay = delay                          # Minimum seconds between requests to a host
+
+        self._queues = defaultdict(deque)           # host -> URLs (and depth) waiting
+        self._load = defaultdict(int)               # host -> fetches running
+        self._delays = {}                           # host -> delay for this host, if not self.delay
+        self._next_time = {}                        # host -> earliest time of the next request
+        self._blocked = set()                       # Hosts that may not be fetched from for now
+
+        self._ready = deque()                       # Hosts that may be fetched from now
+        self._timed = []                            # Heap of (time, host) waiting for their delay
+        self._scheduled = set()                     # Hosts in self._ready or self._timed
+        self._len = 0
+        self._num_hosts = 0                         # Hosts with URLs waiting
+
+    def add(self, url, depth, host):
+        queue = self._queues[host]
+        if not queue:
+            self._num_hosts += 1
+        queue.append((url, depth))
+        self._len += 1
+        self._schedule(host)
+
+    def next(self, now=None):
+        """next() -> (url, depth, host), or None if no host is ready
+
+        The caller has to call done(host) once the fetch has finished."""
+        now = time.monotonic() if now is None else now
+        while self._timed and self._timed[0][0] <= now:
+            t, host = heapq.heappop(self._timed)
+            self._ready.append(host)
+        while self._ready:
+            host = self._ready.popleft()
+            self._scheduled.discard(host)
+            if not self._may_start(host, now):
+                self._schedule(host, now)
+                continue
+            url, depth = self._queues[host].popleft()
+            self._len -= 1
+            if not self._queues[host]:
+                self._num_hosts -= 1
+            self._load[host] += 1
+            self._next_time[host] = now + self._delays.get(host, self.delay)
+            self._schedule(host, now)
+            return url, depth, host
+        return None
+
+    def done(self, host):
+        """A fetch for host has finished"""
+        self._load[host] -= 1
+        if not self._load[host]:
+            del self._load[host]
+        self._schedule(host)
+
+    def block(self, host):
+        """Hand out no URLs for host until unblock() is called"""
+        self._blocked.add(host)
+
+    def is_blocked(self, host):
+        return host in self._blocked
+
+    def unblock(self, host, delay=None):
+        """Allow fetching from host again, with delay seconds between
+        requests if that is longer than the default delay"""
+        self._blocked.discard(host)
+        if delay is not None and delay > self.delay:
+            self._delays[host] = delay
+        self._schedule(host)
+
+    def defer(self, host, seconds, now=None):
+        """Hand out no URLs for host for the next seconds"""
+        now = time.monotonic() if now is None else now
+        self._next_time[host] = max(self._next_time.get(host, 0), now + seconds)
+
+    def expedite(self, host, now=None):
+        """Allow fetching from host right away, ending its delay or deferral"""
+        now = time.monotonic() if now is None else now
+        self._next_time[host] = now
+        if any(h == host for t, h in self._timed):
+            self._timed = [(t, h) for t, h in self._timed if h != host]
+            heapq.heapify(self._timed)
+            self._scheduled.discard(host)
+        self._schedule(host, now)
+
+    def remove_if(self, host, condition):
+        """Remove the URLs waiting for host for which condition(url) is
+        true. Returns the removed URLs."""
+        queue = self._queues.get(host)
+        if not queue:
+            return []
+        keep = deque()
+        removed = []
+        for url, depth in queue:
+            if condition(url):
+                removed.append(url)
+            else:
+                keep.append((url, depth))
+        self._len -= len(removed)
+        self._queues[host] = keep
+        if not keep:
+            self._num_hosts -= 1
+        return removed
+
+    def ready(self, now=None):
+        """Whether a host may be fetched from now"""
+        return self.wakeup(now) == 0
+
+    def wakeup(self, now=None):
+        """Seconds until a waiting host becomes ready, or None if no host is waiting"""
+        if self._ready:
+            return 0
+        if not self._timed:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0, self._timed[0][0] - now)
+
+    def queue_depths(self):
+        """Dict of host -> number of URLs waiting"""
+        return {host: len(queue) for host, queue in self._queues.items() if queue}
+
+    def num_hosts(self):
+        """Number of hosts with URLs waiting"""
+        return self._num_hosts
+
+    def __len__(self):
+        return self._len
+
+    def _may_start(self, host, now):
+        return (self._queues[host] and host not in self._blocked and
+                self._load[host] < self._host_workers(host) and
+                self._next_time.get(host, 0) <= now)
+
+    def _host_workers(self, host):
+        # A host that asked for a crawl delay gets one request at a time
+        return 1 if host in self._delays else self.host_workers
+
+    def _schedule(self, host, now=None):
+        """Put host in the rotation or in the heap if it can be fetched
+        from now or later; otherwise it stays parked until done() or
+        unblock() is called for it."""
+        if host in self._scheduled:
+            return
+        if not self._queues.get(host):
+            self._queues.pop(host, None)
+            return
+        if host in self._blocked or self._load[host] >= self._host_workers(host):
+            return
+        now = time.monotonic() if now is None else now
+        next_time = self._next_time.get(host, 0)
+        if next_time > now:
+            heapq.heappush(self._timed, (next_time, host))
+        else:
+            self._ready.append(host)
+        self._scheduled.add(host)
+
+
+class CircuitBreaker(object):
+
+    """Counts the failures (timeouts, connection errors, server errors) of
+    every host. After threshold failures in a row the breaker of a host
+    trips: the host should be left alone for cooldown seconds, twice as
+    long every next time. Failures during the cooldown (of fetches that
+    were already running) don't count. Once the cooldown is over, a single
+    failure trips it again and a success resets it. A host whose breaker
+    has tripped max_trips times in a row is taken to be down."""
+
+    def __init__(self, threshold=5, cooldown=30, max_trips=3):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.failures = defaultdict(int)            # host -> failures in total
+        self._consecutive = defaultdict(int)        # host -> failures since the last success
+        self._trips = defaultdict(int)              # host -> times tripped since the last success
+        self._open_until = {}                       # host -> end of its cooldown
+        self._down = set()
+
+    def success(self, host):
+        self._consecutive.pop(host, None)
+        self._trips.pop(host, None)
+        self._open_until.pop(host, None)
+
+    def failure(self, host, now=None):
+        """Count a failure of host. Returns the seconds to leave the host
+        alone for if this trips its breaker, or None."""
+        now = time.monotonic() if now is None else now
+        self.failures[host] += 1
+        if self._open_until.get(host, 0) > now:
+            return None
+        self._consecutive[host] += 1
+        if self._consecutive[host] < self.threshold:
+            return None
+        self._consecutive[host] = self.threshold - 1
+        self._trips[host] += 1
+        if self._trips[host] >= self.max_trips:
+            self._down.add(host)
+        pause = self.cooldown * 2 ** (self._trips[host] - 1)
+        self._open_until[host] = now + pause
+        return pause
+
+    def end_cooldown(self, host):
+        """The host is tried again before its cooldown is over"""
+        self._open_until.pop(host, None)
+
+    def is_down(self, host):
+        return host in self._down
+
+    def worst(self, top=10):
+        """The hosts with the most failures, as (host, failures) pairs"""
+        return sorted(self.failures.items(), key=lambda x: x[1], reverse=True)[:top]
+
+
+class RobotsCache(object):
+
+    """The parsed robots.txt of every host, kept for ttl seconds.
+
+    fetch(url) has to return (status, text) for the robots.txt at url,
+    with status 0 if it could not be fetched at all. As in
+    urllib.robotparser, a 401 or 403 disallows everything and any other
+    failure allows everything."""
+
+    def __init__(self, fetch, agent, ttl=24 * 3600):
+        self.fetch = fetch
+        self.agent = agent
+        self.ttl = ttl
+        self._entries = {}                          # host -> (parser, time it expires)
+
+    def needs_load(self, host):
+        entry = self._entries.get(host)
+        return entry is None or entry[1] < time.monotonic()
+
+    def load(self, scheme, host):
+        """Fetch and parse the robots.txt of host. Runs in a worker thread;
+        the result has to be passed to store()."""
+        url = "%s://%s/robots.txt" % (scheme, host)
+        status, text = self.fetch(url)
+        parser = RobotFileParser(url)
+        if status in (401, 403):
+            parser.disallow_all = True
+        elif status != 200:
+            parser.allow_all = True
+        else:
+            parser.parse(text.splitlines())
+        logging.debug("Loaded %s (status %d)" % (url, status))
+        return parser
+
+    def store(self, host, parser):
+        self._entries[host] = (parser, time.monotonic() + self.ttl)
+
+    def loaded(self, host):
+        return host in self._entries
+
+    def allowed(self, host, url):
+        """Whether url may be fetched; True if robots.txt of host is not loaded"""
+        entry = self._entries.get(host)
+        return entry is None or entry[0].can_fetch(self.agent, url)
+
+    def crawl_delay(self, host):
+        entry = self._entries.get(host)
+        if entry is None:
+            return None
+        delay = entry[0].crawl_delay(self.agent)
+        return float(delay) if delay is not None else None
@@ -7,6 +7,9 @@ The script searches on a given website for given queries and
 outputs the ranked results.
 
 First, all subpages are crawled and parsed.
+Instead of crawling, the pages can be read from WARC files
+written by crawler.py --warc, so a site that was crawled once
+can be indexed again without touching the network.
 Next, the PageRank is calculated based
 on the link structure of the pages.
 Then an index of all terms is created,
@@ -15,23 +18,47 @@ Last, the cosine distance between each query
 and each document is calculated.
 The order of the search result is based on a combination
 of the PageRank and cosine similarity.
+Only the best results are looked for: documents are read
+in order of their weight times PageRank, and the search stops
+when the documents not read yet can't be among the best.
+
+The index and PageRank can be saved to disk with --save-index,
+and searched again later with --index, without crawling or indexing.
 
 Example:
     python search.py 'ruby go' https://jorin.me
+    python crawler.py -d 10 --warc jorin.warc.gz https://jorin.me
+    python search.py 'ruby go' --warc jorin.warc.gz --save-index jorin
+    python search.py 'rust' --index jorin
 '''
 
+import os
 import re
+import heapq
 import argparse
 from urllib.parse import urljoin, urlparse
 from urllib.request import urlopen
 from urllib.error import HTTPError
-from collections import Counter, defaultdict
-from math import log10
+from array import array
+from collections import Counter, deque
 from bs4 import BeautifulSoup
 import numpy as np
+try:
+    # Optional, makes Gauss-Seidel PageRank a lot faster
+    from scipy.sparse import csr_matrix, identity, tril, triu
+    from scipy.sparse.linalg import spsolve_triangular
+except ImportError:
+    spsolve_triangular = None
+from warc import read_responses
+from diskindex import InvertedIndex, DiskIndex, write_index
 
 teleportation = 0.05
 target_delta = 0.04
+delta_norm = 1
+max_iterations = 100
+rank_method = 'power'
+anderson_memory = 5
+max_results = 10
 
 stop_words = [
     'a', 'also', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do',
@@ -42,22 +69,44 @@ stop_words = [
 
 def main():
     args = get_args()
+    if args.index:
+        index = DiskIndex(args.index)
+        print('Number of pages:', index.num_docs)
+        print('Terms in index:', len(index))
+        print()
+        print_combined_search(index, args.query, args.k)
+        return
+
     # Computing
-    pages = crawl(args.url)
-    ranks = page_rank(pages)
-    rank = best_rank(ranks, pages)
+    if args.warc:
+        pages = read_warc(args.warc, args.url)
+    else:
+        pages = crawl(args.url)
+    start = None
+    if args.save_index and \
+            os.path.exists(os.path.join(args.save_index, 'index.json')):
+        # Ranks of the previous crawl are a good start
+        try:
+            start = DiskIndex(args.save_index).rank
+        except ValueError:
+            # Saved in an older format; it is replaced
+            pass
+    ranks, iterations = page_rank(pages, start=start)
     N = len(pages)
     index = create_index(pages)
-    weighted_index = weight_index(index, N)
-    norm_index = normalize_index(weighted_index)
+    weights = weight_index(index, N)
+    norm_weights = normalize_index(index, weights)
+    norm_index = invert_index(index, norm_weights, pages, ranks)
+    if args.save_index:
+        write_index(args.save_index, norm_index)
 
     # Print results
     print()
     print('Number of pages:', len(pages))
-    print('Terms in index:', len(index))
-    print('Interations for PageRank:', len(ranks))
+    print('Terms in index:', len(norm_index))
+    print('Interations for PageRank:', iterations)
     print()
-    print_combined_search(norm_index, N, rank, args.query)
+    print_combined_search(norm_index, args.query, args.k)
 
 
 def get_args():
@@ -73,10 +122,40 @@ def get_args():
     parser.add_argument(
         'url',
         type=str,
-        nargs='+',
+        nargs='*',
         help='At least one seed url for the crawler to start from'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '-k',
+        type=int,
+        default=max_results,
+        help='Number of results to show (default %(default)s)'
+    )
+    parser.add_argument(
+        '--warc',
+        type=str,
+        action='append',
+        metavar='FILE',
+        help='Read the pages from this WARC file instead of crawling; '
+             'seed urls, if given, only limit the hosts of the links'
+    )
+    parser.add_argument(
+        '--save-index',
+        type=str,
+        metavar='DIR',
+        help='Save the index and PageRank in this directory'
+    )
+    parser.add_argument(
+        '--index',
+        type=str,
+        metavar='DIR',
+        help='Search the index saved in this directory '
+             'instead of crawling and indexing'
+    )
+    args = parser.parse_args()
+    if not args.url and not args.warc and not args.index:
+        parser.error('give at least one seed url, a --warc file or an --index')
+    return args
 
 
 # Crawler
@@ -112,6 +191,29 @@ def download(url):
     return urlopen(url)
 
 
+def read_warc(paths, urls):
+    '''
+    Takes a list of WARC files and a list of seed urls as arguments.
+    Nothing is downloaded.
+
+    Returns a sorted list of tuples (url, content, links) like crawl,
+    for the HTML pages in the files. Links are kept if they point to
+    the hosts of the seed urls or, without seed urls,
+    to any host in the files.
+    '''
+    responses = [(url, body) for url, status, content_type, body
+                 in read_responses(paths)
+                 if status == 200 and content_type == 'text/html']
+    bases = {urlparse(u).netloc for u in urls or [u for u, _ in responses]}
+    pages = {}
+    for url, body in responses:
+        url = url.rstrip('/')
+        if url not in pages:
+            pages[url] = parse(body, url, bases)
+    print('read %s pages from %s' % (len(pages), ', '.join(paths)))
+    return sorted(pages.values())
+
+
 def parse(html, url, bases):
     '''
     Takes an html string and a url as arguments.
@@ -120,61 +222,235 @@ def parse(html, url, bases):
     '''
     soup = BeautifulSoup(html, 'lxml')
 
-    content = soup.body.get_text().strip()
+    content = (soup.body or soup).get_text().strip()
 
     links = [urljoin(url, l.get('href')) for l in soup.findAll('a')]
     links = [l for l in links if urlparse(l).netloc in bases]
     return url, content, links
 
 
-def page_rank(pages):
+def page_rank(pages, tolerance=target_delta, norm=delta_norm,
+              max_iter=max_iterations, method=rank_method, start=None):
     '''
-    Returns a matrix with documents as columns
-    and values for each round as rows.
+    Returns a tuple (ranks, iterations).
+    ranks holds the PageRank of each document in the order of pages,
+    adding up to 1.
+
+    The ranks are improved until they change less than tolerance,
+    measured with norm (1, 2 or np.inf), or for max_iter iterations.
+    method is one of rank_methods:
+    'power' is the power iteration,
+    'gauss-seidel' uses new ranks as soon as they are computed,
+    which takes the fewest iterations, and
+    'anderson' extrapolates from the last anderson_memory iterations.
+
+    start is a dict with document urls as keys and ranks as values,
+    such as best_rank returned before a re-crawl,
+    to start from instead of equal ranks.
+    '''
+    graph = create_transition_graph(pages)
+    ranks = start_ranks(get_urls(pages), start)
+    ranks, iterations = rank_methods[method](
+        graph, ranks, tolerance, norm, max_iter)
+    return ranks / ranks.sum(), iterations
+
 
-    Number of rows depends on how long it takes to reach the target_delta.
+def start_ranks(urls, start=None):
     '''
-    N = len(pages)
-    transition_matrix = create_transition_matrix(pages)
-    ranks_in_steps = [[1 / N] * N]
-    while True:
-        possibilities = ranks_in_steps[-1] * transition_matrix
-        delta = get_delta(possibilities, ranks_in_steps[-1])
-        ranks_in_steps.append(np.squeeze(np.asarray(possibilities)))
-        if delta <= target_delta:
-            return ranks_in_steps
+    Returns the ranks to start iterating from, adding up to 1.
+
+    Documents that are not in start get the average rank of those that are.
+    '''
+    N = len(urls)
+    known = [start[u] for u in urls if u in start] if start else []
+    if not known or sum(known) <= 0:
+        return np.full(N, 1 / N)
+    average = sum(known) / len(known)
+    ranks = np.array([start.get(u, average) for u in urls], dtype=np.float64)
+    return ranks / ranks.sum()
 
 
-def create_transition_matrix(pages):
+def create_transition_graph(pages):
+    '''
+    Returns the links between documents as a sparse matrix
+    in CSR form: a tuple (indptr, indices, weights, dangling).
+    Documents are numbered in the order of pages.
+
+    Row i holds the documents that document i links to,
+    each with the propability 1 / (number of links of i).
+    Documents without any links are marked in dangling.
+    Teleportation is not stored, it is added by step.
+    '''
+    ids = {url: i for i, url in enumerate(get_urls(pages))}
+    indptr = [0]
+    indices = []
+    weights = []
+    dangling = np.zeros(len(pages), dtype=bool)
+    for i, links in enumerate(get_links(pages)):
+        if not links:
+            dangling[i] = True
+        else:
+            targets = sorted({ids[l] for l in links if l in ids})
+            indices.extend(targets)
+            weights.extend([1 / len(links)] * len(targets))
+        indptr.append(len(indices))
+    return (np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int64),
+            np.array(weights, dtype=np.float64),
+            dangling)
+
+
+def step(graph, ranks):
     '''
-    Returns a matrix with document urls as rows
-    and document links as columns.
+    Returns the ranks after one more round of the power iteration.
 
-    Each cell contains the propability for a document
-    to transition to a link.
+    Links are followed with the propability 1 - teleportation,
+    otherwise any document is equally likely.
+    After a dangling document any document is equally likely too.
+
+    Rank that follows links to urls that are not documents is lost,
+    so the total of the ranks goes down with every step
+    (see normalized_step).
     '''
-    links = get_links(pages)
-    urls = get_urls(pages)
-    N = len(pages)
-    m = np.matrix([[weight_link(N, u, l) for u in urls] for l in links])
-    return teleport(N, m)
+    indptr, indices, weights, dangling = graph
+    N = len(ranks)
+    sources = np.repeat(ranks, np.diff(indptr))
+    followed = np.bincount(indices, weights=sources * weights, minlength=N)
+    spread = ranks[dangling].sum() / N
+    return (1 - teleportation) * (followed + spread) + teleportation * ranks.sum() / N
 
 
-def weight_link(N, url, links):
-    if not links:
-        return 1 / N
-    if url in links:
-        return 1 / len(links)
-    else:
-        return 0
+def normalized_step(graph, ranks):
+    '''
+    Returns step(graph, ranks) scaled to add up to 1.
 
+    Repeating it gives the same ranks as repeating step
+    and normalizing at the end, but the change from one round
+    to the next no longer includes the rank that is lost.
+    '''
+    stepped = step(graph, ranks)
+    return stepped / stepped.sum()
 
-def teleport(N, m):
-    return m * (1 - teleportation) + teleportation / N
 
+def power_iteration(graph, ranks, tolerance, norm, max_iter):
+    '''
+    Returns a tuple (ranks, iterations),
+    repeating normalized_step until the ranks change less than tolerance.
+    '''
+    iterations = 0
+    while iterations < max_iter:
+        new_ranks = normalized_step(graph, ranks)
+        iterations += 1
+        delta = get_delta(new_ranks, ranks, norm)
+        ranks = new_ranks
+        if delta <= tolerance:
+            break
+    return ranks, iterations
+
+
+def anderson_iteration(graph, ranks, tolerance, norm, max_iter):
+    '''
+    Like power_iteration, but the new ranks are extrapolated
+    from the last anderson_memory steps:
+    the combination of them that changes the least is taken
+    (Anderson acceleration).
 
-def get_delta(a, b):
-    return np.abs(a - b).sum()
+    The steps are normalized, as extrapolating from ranks that
+    lose rank would take the loss for a change.
+    '''
+    changes = deque(maxlen=anderson_memory)
+    steps = deque(maxlen=anderson_memory)
+    last = None
+    iterations = 0
+    while iterations < max_iter:
+        stepped = normalized_step(graph, ranks)
+        change = stepped - ranks
+        iterations += 1
+        if get_delta(stepped, ranks, norm) <= tolerance:
+            return stepped, iterations
+        if last is not None:
+            changes.append(change - last[0])
+            steps.append(stepped - last[1])
+        last = change, stepped
+        ranks = stepped
+        if changes:
+            gamma = np.linalg.lstsq(np.column_stack(changes), change,
+                                    rcond=None)[0]
+            ranks = stepped - np.column_stack(steps) @ gamma
+    return ranks, iterations
+
+
+def gauss_seidel(graph, ranks, tolerance, norm, max_iter):
+    '''
+    Like power_iteration, but the documents are updated one by one
+    and each update already uses the new ranks of the documents before it.
+    Rank from dangling documents and teleportation are spread
+    as they were at the start of each round.
+
+    The ranks power_iteration converges to, normalized,
+    are those for which a step gives the same ranks times the factor
+    by which their total goes down (see step). A round divides by
+    that factor, as found for the ranks at its start,
+    and normalizes the new ranks.
+    '''
+    indptr, indices, weights, dangling = graph
+    N = len(ranks)
+    if spsolve_triangular is not None:
+        # A round solves (factor I - L) x = U ranks + spread,
+        # with L and U the parts below and from the diagonal
+        # of the transposed transition matrix
+        links = csr_matrix((weights, indices, indptr), shape=(N, N))
+        links = (links.T * (1 - teleportation)).tocsr()
+        strict_lower = tril(links, -1, format='csr')
+        upper = triu(links, format='csr')
+
+        def solve(x, factor, spread):
+            lower = (identity(N, format='csr') * factor - strict_lower).tocsr()
+            return spsolve_triangular(lower, upper @ x + spread, lower=True)
+    else:
+        # The same matrix by column: the links to each document
+        order = np.argsort(indices, kind='stable')
+        in_ptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(indices, minlength=N)))).tolist()
+        in_sources = np.repeat(np.arange(N), np.diff(indptr))[order].tolist()
+        in_weights = weights[order].tolist()
+
+        def solve(x, factor, spread):
+            x = x.tolist()
+            for j in range(N):
+                a, b = in_ptr[j], in_ptr[j + 1]
+                followed = sum(x[i] * w for i, w in
+                               zip(in_sources[a:b], in_weights[a:b]))
+                x[j] = ((1 - teleportation) * followed + spread) / factor
+            return np.array(x)
+
+    def sweep(x):
+        factor = step(graph, x).sum() / x.sum()
+        spread = ((1 - teleportation) * x[dangling].sum() +
+                  teleportation * x.sum()) / N
+        x = solve(x, factor, spread)
+        return x / x.sum()
+
+    iterations = 0
+    while iterations < max_iter:
+        new_ranks = sweep(ranks)
+        iterations += 1
+        delta = get_delta(new_ranks, ranks, norm)
+        ranks = new_ranks
+        if delta <= tolerance:
+            break
+    return ranks, iterations
+
+
+rank_methods = {
+    'power': power_iteration,
+    'gauss-seidel': gauss_seidel,
+    'anderson': anderson_iteration,
+}
+
+
+def get_delta(a, b, norm=1):
+    return np.linalg.norm(a - b, norm)
 
 
 def get_urls(pages):
@@ -190,24 +466,36 @@ def best_rank(ranks, pages):
     Returns a dict with document urls as keys
     and their ranks as values.
     '''
-    return dict(zip(get_urls(pages), ranks[-1]))
+    return dict(zip(get_urls(pages), ranks))
 
 
 # Index
 
 def create_index(pages):
     '''
-    Returns the index as a dict with terms as keys
-    and lists tuples(url, count) as values.
+    Returns the index as a sparse matrix of documents by terms,
+    a tuple (terms, doc_ids, term_ids, counts).
+    terms is a sorted list; documents are numbered in the order of pages.
 
-    Count says how many times the term occured in the document.
+    Every document and term it contains has an entry:
+    count says how many times the term occured in the document.
     '''
-    index = defaultdict(list)
-    for url, content, links in pages:
-        counts = count_terms(content)
-        for term, count in counts.items():
-            index[term].append((url, count))
-    return index
+    term_numbers = {}
+    doc_ids = array('i')
+    term_ids = array('i')
+    counts = array('i')
+    for doc, (url, content, links) in enumerate(pages):
+        for term, count in count_terms(content).items():
+            doc_ids.append(doc)
+            term_ids.append(term_numbers.setdefault(term, len(term_numbers)))
+            counts.append(count)
+    # Number the terms in sorted order
+    terms = sorted(term_numbers)
+    renumber = np.empty(len(terms), dtype=np.int32)
+    renumber[[term_numbers[t] for t in terms]] = np.arange(len(terms))
+    term_ids = renumber[np.frombuffer(term_ids, dtype=np.int32)]
+    return (terms, np.frombuffer(doc_ids, dtype=np.int32), term_ids,
+            np.frombuffer(counts, dtype=np.int32))
 
 
 def count_terms(content):
@@ -237,15 +525,11 @@ def weight_index(index, N):
     Takes an index as first argument
     and the total number of documents as second argument.
 
-    Returns a new index with tf_idf weights instead of simple counts.
+    Returns the tf_idf weights of the entries of the index.
     '''
-    weighted_index = defaultdict(list)
-    for term, docs in index.items():
-        df = len(docs)
-        for url, count in docs:
-            weight = tf_idf(count, N, df)
-            weighted_index[term].append((url, weight))
-    return weighted_index
+    terms, doc_ids, term_ids, counts = index
+    df = np.bincount(term_ids, minlength=len(terms))
+    return tf_idf(counts, N, df[term_ids])
 
 
 def tf_idf(tf, N, df):
@@ -253,78 +537,208 @@ def tf_idf(tf, N, df):
 
 
 def wtf(tf):
-    return 1 + log10(tf)
+    return 1 + np.log10(tf)
 
 
 def idf(N, df):
-    return log10(N / df)
+    return np.log10(N / df)
 
 
-def normalize_index(index):
+def normalize_index(index, weights):
     '''
-    Takes an index as argument.
+    Takes an index and the weights of its entries as arguments.
 
-    Returns a new index with normalized weights.
+    Returns the weights divided by the length of their document.
+    A document of length 0 (all its terms are in every document)
+    keeps its weights of 0.
     '''
-    lengths = doc_lengths(index)
-    norm_index = defaultdict(list)
-    for term, docs in index.items():
-        for url, weight in docs:
-            norm_index[term].append((url, weight / lengths[url]))
-    return norm_index
+    terms, doc_ids, term_ids, counts = index
+    lengths = doc_lengths(index, weights)[doc_ids]
+    return np.divide(weights, lengths, out=np.zeros_like(weights), where=lengths > 0)
 
 
-def doc_lengths(index):
+def doc_lengths(index, weights):
     '''
-    Returns a dict with document urls as keys
-    and vector lengths as values.
+    Returns an array with the vector length of each document.
 
     The length is calculated using the vector of weights
     for the terms in the document.
     '''
-    doc_vectors = defaultdict(list)
-    for docs in index.values():
-        for url, weight in docs:
-            doc_vectors[url].append(weight)
-    return {url: np.linalg.norm(doc) for url, doc in doc_vectors.items()}
+    terms, doc_ids, term_ids, counts = index
+    return np.sqrt(np.bincount(doc_ids, weights=weights ** 2))
+
+
+def invert_index(index, weights, pages, ranks):
+    '''
+    Takes an index, the weights of its entries, the pages
+    and their PageRank as arguments.
+
+    Returns an InvertedIndex (see diskindex.py) with the postings
+    of each term, which is what searching needs.
+    '''
+    terms, doc_ids, term_ids, counts = index
+    ranks = np.asarray(ranks)
+    # The entries are in order of document, so a stable sort
+    # keeps the postings of each term in that order
+    order = np.argsort(term_ids, kind='stable')
+    doc_ids, weights, term_ids = doc_ids[order], weights[order], term_ids[order]
+    df = np.bincount(term_ids, minlength=len(terms))
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    # By term, then by impact (highest first), then by document
+    by_impact = np.lexsort((-(weights * ranks[doc_ids]), term_ids))
+    impact_order = (by_impact - np.repeat(offsets[:-1], df)).astype(np.int32)
+    return InvertedIndex(terms, offsets, doc_ids, weights, impact_order,
+                         get_urls(pages), ranks)
 
 
 # Search & Scoring
 
-def cosine_similarity(index, N, query):
+def query_weights(index, query):
     '''
     query is a string of terms.
 
-    Returns a sorted list of tuples (url, score).
+    Returns a dict with the terms of the query that are in the index
+    as keys and their normalized tf-idf weights as values.
+    '''
+    N = index.num_docs
+    qw = {t: tf_idf(1, N, index.document_frequency(t)) for t in query.split() if t in index}
+    query_len = np.linalg.norm(list(qw.values()))
+    return {t: w / query_len if query_len else 0.0 for t, w in qw.items()}
+
+
+def cosine_similarity(index, query, k=max_results):
+    '''
+    query is a string of terms.
+
+    Returns a sorted list of the k best tuples (url, score),
+    all if k is None.
 
     Score is calculated using the cosine distance
     between document and query.
     '''
-    scores = defaultdict(int)
-    terms = query.split()
-    qw = {t: tf_idf(1, N, len(index[t])) for t in terms if t in index}
-    query_len = np.linalg.norm(list(qw.values()))
-    for term in qw:
-        query_weight = qw[term] / query_len
-        for url, weight in index[term]:
-            scores[url] += weight * query_weight
-    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    scores = np.zeros(index.num_docs)
+    matched = [np.zeros(0, dtype=np.int32)]
+    for term, query_weight in query_weights(index, query).items():
+        doc_ids, weights = index.postings(term)
+        scores[doc_ids] += weights * query_weight
+        matched.append(doc_ids)
+    docs = np.unique(np.concatenate(matched)).astype(np.int64)
+    if k is None:
+        k = len(docs)
+    best = heapq.nlargest(k, zip(scores[docs].tolist(), (-docs).tolist()))
+    return [(index.urls[-doc], score) for score, doc in best]
+
+
+class ImpactCursor(object):
+    '''
+    Reads the postings of a term in order of impact
+    (weight times PageRank, times the weight of the term in the query).
 
+    bound is the most the term can add to the score of
+    a document that was not read yet.
+    '''
 
-def combined_search(index, N, rank, query):
+    def __init__(self, index, term, query_weight):
+        self.doc_ids, self.weights, self.order = index.impact_postings(term)
+        self.ranks = index.ranks
+        self.query_weight = query_weight
+        self.position = 0
+        self.bound = self.impact(0)
+
+    def impact(self, position):
+        if position >= len(self.order):
+            return 0.0
+        i = self.order[position]
+        return float(self.query_weight * self.weights[i] * self.ranks[self.doc_ids[i]])
+
+    def done(self):
+        return self.position >= len(self.order)
+
+    def next_block(self, size):
+        '''
+        Returns the documents of the next size postings.
+        '''
+        positions = self.order[self.position:self.position + size]
+        self.position += len(positions)
+        self.bound = self.impact(self.position)
+        return self.doc_ids[positions].tolist()
+
+    def weight(self, docs):
+        '''
+        Returns the weight of the term in each of docs,
+        0 where the term is not in the document.
+        '''
+        if not len(self.doc_ids):
+            return np.zeros(len(docs))
+        i = np.minimum(np.searchsorted(self.doc_ids, docs), len(self.doc_ids) - 1)
+        return np.where(self.doc_ids[i] == docs, self.weights[i], 0) * self.query_weight
+
+
+def essential_terms(cursors, kth_score):
     '''
-    Returns a sorted list of tuples (url, score).
+    Returns the cursors that still have to be read (MaxScore).
 
-    Score is the product of the cosine similarity and the PageRank.
+    A document that was not read yet, and only occurs in terms whose
+    bounds add up to less than kth_score, can't get in the top k:
+    the terms with the lowest bounds can be left,
+    and the search is done when all of them can.
     '''
-    scores = cosine_similarity(index, N, query)
-    combined = [(doc, score * rank[doc]) for doc, score in scores]
-    return sorted(combined, key=lambda x: x[1], reverse=True)
+    essential = []
+    total = 0.0
+    for cursor in sorted(cursors, key=lambda c: c.bound):
+        total += cursor.bound
+        if total >= kth_score and not cursor.done():
+            essential.append(cursor)
+    return essential
+
 
+def combined_search(index, query, k=max_results):
+    '''
+    Returns a sorted list of the k best tuples (url, score),
+    all if k is None.
 
-def print_combined_search(index, N, rank, query):
+    Score is the product of the cosine similarity and the PageRank.
+
+    That is the sum over the query terms of their weights in the
+    document times PageRank (impact), so the postings are read in order
+    of impact, in blocks that double in size, and every document
+    that turns up is scored with all terms. Reading stops when
+    the documents not read yet can't beat the k best found,
+    so the time taken depends on k more than on the number
+    of documents that match.
+    '''
+    if k is None:
+        k = index.num_docs
+    if k < 1:
+        return []
+    cursors = [ImpactCursor(index, t, w) for t, w in query_weights(index, query).items()]
+    heap = []
+    scored = set()
+    block = max(k, 16)
+    while True:
+        kth_score = heap[0][0] if len(heap) == k else -np.inf
+        essential = essential_terms(cursors, kth_score)
+        if not essential:
+            break
+        for cursor in essential:
+            docs = [d for d in cursor.next_block(block) if d not in scored]
+            scored.update(docs)
+            docs = np.array(docs, dtype=np.int64)
+            scores = sum(c.weight(docs) for c in cursors) * index.ranks[docs]
+            # Ties go to the document that was crawled first
+            for entry in zip(scores.tolist(), (-docs).tolist()):
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        block *= 2
+    return [(index.urls[-doc], score) for score, doc in sorted(heap, reverse=True)]
+
+
+def print_combined_search(index, query, k=max_results):
     print('Search results for "%s":' % (query))
-    for url, score in combined_search(index, N, rank, query):
+    for url, score in combined_search(index, query, k):
         print('%.6f  %s' % (score, url))
 
 
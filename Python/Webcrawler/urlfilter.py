@@ -0,0 +1,184 @@
+"""
+  Building blocks for the URL filters of crawler.py. The filters run for
+  every link found, so they are precompiled from the crawler settings:
+
+  - parse_url() splits a URL once and caches the result, so the filters
+    that look at the host don't each parse the URL again;
+  - a PrefixTrie matches a URL against any number of prefixes in one walk
+    over the URL;
+  - a HostRule tells whether a host is a given host or one of its
+    subdomains.
+
+  A UrlCanonicalizer rewrites every link found to a canonical form before
+  it is filtered, so that URLs that only differ in spelling are fetched
+  once.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+ParsedUrl = namedtuple("ParsedUrl", "scheme netloc host path query")
+ParsedUrl.__doc__ = """A split URL; host is the netloc in lower case"""
+
+INVALID_URL = ParsedUrl("", "", "", "", "")
+
+
+@lru_cache(maxsize=100000)
+def parse_url(url):
+    """Split url into a ParsedUrl; INVALID_URL if it can't be split"""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return INVALID_URL
+    return ParsedUrl(parts.scheme, parts.netloc, parts.netloc.lower(), parts.path, parts.query)
+
+
+class PrefixTrie(object):
+
+    """A set of string prefixes, stored as a character trie"""
+
+    _END = None                                     # Key marking the end of a prefix in a node
+
+    def __init__(self, prefixes=()):
+        self._root = {}
+        self._len = 0
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        if self._END not in node:
+            node[self._END] = True
+            self._len += 1
+
+    def matches(self, s):
+        """True if any prefix in the trie is a prefix of s"""
+        node = self._root
+        if self._END in node:
+            return True
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+    def __len__(self):
+        return self._len
+
+
+class HostRule(object):
+
+    """Matches a host name and all of its subdomains. A port given with
+    the host has to match as well."""
+
+    def __init__(self, host):
+        self.host = host.lower()
+        self._suffix = "." + self.host
+
+    def matches(self, host):
+        """host has to be in lower case, like ParsedUrl.host"""
+        return host == self.host or host.endswith(self._suffix)
+
+
+CANONICAL_RULES = ("case",                          # Scheme and host in lower case
+                   "port",                          # No default port (80 for http, 443 for https)
+                   "dots",                          # No . and .. path segments, and / for an empty path
+                   "sort-query",                    # Query parameters sorted
+                   "strip-params",                  # No query (or ;path) parameters from the strip list
+                   "trailing-slash")                # No / at the end of a path, except for the root
+
+DEFAULT_CANONICAL_RULES = CANONICAL_RULES[:-1]
+
+# Parameters that track visitors or sessions rather than select content;
+# a name ending in * matches every name that starts with the rest
+STRIP_PARAMS = ("utm_*", "gclid", "fbclid", "msclkid", "mc_cid", "mc_eid",
+                "jsessionid", "phpsessid", "aspsessionid*", "sessionid", "sid")
+
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+
+def remove_dot_segments(path):
+    """Resolve the . and .. segments of path, as in RFC 3986, section 5.2.4"""
+    if "." not in path:
+        return path
+    segments = path.split("/")
+    output = []
+    for segment in segments[1:] if path.startswith("/") else segments:
+        if segment == "..":
+            if output:
+                output.pop()
+        elif segment != ".":
+            output.append(segment)
+    if segments[-1] in (".", ".."):
+        output.append("")                           # A path ending in a dot segment still ends in /
+    return ("/" if path.startswith("/") else "") + "/".join(output)
+
+
+class UrlCanonicalizer(object):
+
+    """Rewrites a URL to a canonical form, applying the given rules (see
+    CANONICAL_RULES) and always dropping the fragment. strip_params are
+    the names of the parameters removed by the strip-params rule, compared
+    without regard to case. Encoded characters are left as they are."""
+
+    def __init__(self, rules=DEFAULT_CANONICAL_RULES, strip_params=STRIP_PARAMS):
+        unknown = set(rules) - set(CANONICAL_RULES)
+        if unknown:
+            raise ValueError("unknown canonicalization rules: %s" % ", ".join(sorted(unknown)))
+        self.rules = frozenset(rules)
+        names = [name.lower() for name in strip_params]
+        self._strip_names = frozenset(name for name in names if not name.endswith("*"))
+        self._strip_prefixes = tuple(name[:-1] for name in names if name.endswith("*"))
+
+    def _stripped(self, name):
+        name = name.lower()
+        return name in self._strip_names or name.startswith(self._strip_prefixes)
+
+    def __call__(self, url):
+        try:
+            scheme, netloc, path, query, fragment = urlsplit(url)
+        except ValueError:
+            return url
+        rules = self.rules
+
+        if netloc and ("case" in rules or "port" in rules):
+            userinfo, at, hostport = netloc.rpartition("@")
+            if "case" in rules:
+                scheme = scheme.lower()
+                hostport = hostport.lower()
+            if "port" in rules:
+                port = DEFAULT_PORTS.get(scheme.lower())
+                if port is not None and hostport.endswith(port):
+                    hostport = hostport[:-len(port)]
+                elif hostport.endswith(":"):
+                    hostport = hostport[:-1]
+            netloc = userinfo + at + hostport
+
+        if "dots" in rules:
+            path = remove_dot_segments(path)
+            if not path and netloc:
+                path = "/"
+
+        if "strip-params" in rules and ";" in path:
+            # Session IDs in path parameters, like /page;jsessionid=1234
+            path = "/".join(";".join([p for i, p in enumerate(segment.split(";"))
+                                      if i == 0 or not self._stripped(p.partition("=")[0])])
+                            for segment in path.split("/"))
+
+        if query and ("strip-params" in rules or "sort-query" in rules):
+            params = [p for p in query.split("&") if p]
+            if "strip-params" in rules:
+                params = [p for p in params if not self._stripped(p.partition("=")[0])]
+            if "sort-query" in rules:
+                params.sort()
+            query = "&".join(params)
+
+        if "trailing-slash" in rules and len(path) > 1 and path.endswith("/"):
+            path = path.rstrip("/") or "/"
+
+        return urlunsplit((scheme, netloc, path, query, ""))
@@ -0,0 +1,153 @@
+"""
+  WARC files for crawler.py and selite.py. crawler.py can write the pages
+  it fetches to a WARC file (the format web archives use), so they can be
+  indexed later, as often as needed, without crawling again: selite.py
+  reads them back with read_responses().
+
+  Every record is compressed as a gzip member of its own, as in the usual
+  .warc.gz files, so a file can be appended to (a resumed crawl) and other
+  WARC tools can read it. The HTTP response is stored with the body as the
+  crawler decoded it: without its Content-Encoding, and cut off at the
+  crawler's maximum page size (marked with WARC-Truncated).
+"""
+
+import gzip
+import uuid
+import threading
+from datetime import datetime, timezone
+
+WARC_VERSION = b"WARC/1.0"
+COMPRESS_LEVEL = 6
+
+# Response headers that describe the body as it was sent, not as stored
+_TRANSFER_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+
+def warc_date(when=None):
+    """A WARC-Date, the time in UTC to the second"""
+    when = when or datetime.now(timezone.utc)
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def shard_path(path, index):
+    """The WARC file for process index of a multi-process crawl: the number
+    goes before the .warc or .warc.gz extension, so the files keep it"""
+    for ext in (".warc.gz", ".warc"):
+        if path.endswith(ext):
+            return "%s.%d%s" % (path[:-len(ext)], index, ext)
+    return "%s.%d" % (path, index)
+
+
+def _record(warc_type, fields, block):
+    """A complete record, not compressed"""
+    head = [WARC_VERSION,
+            b"WARC-Type: " + warc_type.encode("ascii"),
+            b"WARC-Record-ID: <urn:uuid:" + str(uuid.uuid4()).encode("ascii") + b">"]
+    for name, value in fields:
+        head.append(("%s: %s" % (name, value)).encode("utf-8"))
+    head.append(b"Content-Length: " + str(len(block)).encode("ascii"))
+    return b"\r\n".join(head) + b"\r\n\r\n" + block + b"\r\n\r\n"
+
+
+def response_record(url, status, reason, headers, body, truncated=False, when=None):
+    """A gzip-compressed response record for url. headers are the (name,
+    value) pairs of the HTTP response and body its decoded body. This does
+    the work of compressing, so it is meant to be called from the thread
+    that fetched the page."""
+    lines = ["HTTP/1.1 %d %s" % (status, reason)]
+    lines.extend("%s: %s" % (name, value) for name, value in headers if name.lower() not in _TRANSFER_HEADERS)
+    lines.append("Content-Length: %d" % len(body))
+    http = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1", errors="replace") + body
+    fields = [("WARC-Date", warc_date(when)),
+              ("WARC-Target-URI", url),
+              ("Content-Type", "application/http; msgtype=response")]
+    if truncated:
+        fields.append(("WARC-Truncated", "length"))
+    return gzip.compress(_record("response", fields, http), COMPRESS_LEVEL)
+
+
+class WarcWriter(object):
+
+    """Writes records made by response_record() to path, after a warcinfo
+    record naming software. With append True, an existing file is added to
+    instead of replaced. May be used from several threads."""
+
+    def __init__(self, path, append=False, software="crawler.py"):
+        self.path = path
+        self._file = open(path, "ab" if append else "wb")
+        self._lock = threading.Lock()
+        self.num_records = 0
+        info = ("software: %s\r\nformat: WARC File Format 1.0\r\n" % software).encode("utf-8")
+        self.write(gzip.compress(_record("warcinfo", [("WARC-Date", warc_date()),
+                                                      ("WARC-Filename", path.rsplit("/", 1)[-1]),
+                                                      ("Content-Type", "application/warc-fields")], info),
+                                 COMPRESS_LEVEL))
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(record)
+            self.num_records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _open(path):
+    """Open a WARC file for reading, compressed or not"""
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    return gzip.open(path, "rb") if magic == b"\x1f\x8b" else open(path, "rb")
+
+
+def read_records(path):
+    """Yields (headers, block) for every record in the WARC file at path,
+    with headers a dict of the WARC header fields by lower-case name"""
+    with _open(path) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            if not line.startswith(b"WARC/"):
+                raise ValueError("%s: not a WARC record: %r" % (path, line[:40]))
+            headers = {}
+            for line in iter(f.readline, b""):
+                line = line.rstrip(b"\r\n")
+                if not line:
+                    break
+                name, _, value = line.decode("utf-8", errors="replace").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            block = f.read(int(headers.get("content-length", 0)))
+            yield headers, block
+
+
+def parse_http_response(block):
+    """parse_http_response(block) -> status, headers, body
+
+    headers is a dict of the HTTP header fields by lower-case name"""
+    head, _, body = block.partition(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers, body
+
+
+def read_responses(paths):
+    """Yields (url, status, content type, body) for every HTTP response
+    in the WARC files at paths, in the order they were written"""
+    for path in paths:
+        for headers, block in read_records(path):
+            if headers.get("warc-type") != "response" or not headers.get("content-type", "").startswith("application/http"):
+                continue
+            status, http_headers, body = parse_http_response(block)
+            content_type = http_headers.get("content-type", "").split(";")[0].strip().lower()
+            yield headers.get("warc-target-uri"), status, content_type, body